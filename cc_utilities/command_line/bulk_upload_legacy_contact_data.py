@@ -4,12 +4,15 @@ import io
 import json
 import sys
 from datetime import datetime
-from pathlib import Path, PurePath
+from math import isnan
+from pathlib import Path
 
 import pandas as pd
+import xlsxwriter
 from openpyxl import load_workbook
 
 from cc_utilities.legacy_upload import (
+    DEFAULT_UPLOAD_MAX_WORKERS,
     LegacyUploadError,
     clean_raw_case_data_df,
     generate_commcare_case_report_url,
@@ -25,26 +28,95 @@ from cc_utilities.logger import logger
 VALIDATION_REPORT_FILE_NAME_PART = "validation_report"
 FINAL_REPORT_FILE_NAME_PART = "final_report"
 WB_CONTACT_SHEET_NAME = "contacts"
+# Reports are written with xlsxwriter, which is much faster than openpyxl for writes.
+# In constant memory mode each row is flushed to disk once the next one is started.
+# URL detection is turned off because it is slow and we don't need links to be
+# clickable.
+REPORT_XL_WB_OPTIONS = {"constant_memory": True, "strings_to_urls": False}
 
 
-def convert_xl_wb_to_csv_string_io(wb_path, sheet_name=WB_CONTACT_SHEET_NAME):
-    """Used to accomodate Excel workbook inputs
-    Converts an Excel workbook into a string IO representing the data as a CSV.
+def _make_column_names(header, width):
+    """Name columns exactly as `pd.read_csv` does for a header row
 
-    NB: We use this approach rather than using pd.read_excel because we need all values
-    to be treated as text and read_excel can lead to inferred data types we don't want
+    Blank (or missing, if the header is narrower than the data) names become
+    `Unnamed: <position>` and repeated names get numbered suffixes. pandas has
+    changed how it does this between releases, so rather than copy it, the header
+    row alone is run through `pd.read_csv`.
     """
-    path = Path(wb_path).expanduser()
-    wb = load_workbook(path)
-    ws = wb[sheet_name]
     output = io.StringIO()
-    writer = csv.writer(output)
-    for row in ws.rows:
-        # only want non-empty rows
-        if any([cell.value for cell in row]):
-            writer.writerow([cell.value for cell in row])
+    csv.writer(output).writerow(header + [""] * (width - len(header)))
     output.seek(0)
-    return output
+    return list(pd.read_csv(output, nrows=0).columns)
+
+
+def load_xl_wb_sheet_as_df(wb_path, sheet_name=WB_CONTACT_SHEET_NAME):
+    """Load a sheet of an Excel workbook into a dataframe of strings
+
+    We use this approach rather than using pd.read_excel because we need all values
+    to be treated as text and read_excel can lead to inferred data types we don't want.
+
+    The frame is built in a single pass over the sheet. Empty rows are skipped, the
+    first remaining row is the header, and empty cells become empty strings. Column
+    names follow `pd.read_csv` conventions for blank and duplicate header cells, so
+    the result is the same as reading the sheet as CSV with `keep_default_na=False`
+    and `dtype=str`.
+    """
+    path = Path(wb_path).expanduser()
+    rows = []
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in wb[sheet_name].rows:
+            values = [cell.value for cell in row]
+            # only want non-empty rows
+            if any(values):
+                rows.append(["" if value is None else str(value) for value in values])
+    finally:
+        wb.close()
+    if not rows:
+        return pd.DataFrame()
+    width = max(len(row) for row in rows)
+    columns = _make_column_names(rows[0], width)
+    records = [row + [""] * (width - len(row)) for row in rows[1:]]
+    return pd.DataFrame.from_records(records, columns=columns)
+
+
+def write_df_to_xl_wb(df, wb_path, sheet_name=WB_CONTACT_SHEET_NAME):
+    """Write a dataframe to a single-sheet Excel workbook, one row at a time
+
+    `df.to_excel` writes column by column, which means the whole sheet has to be held
+    in memory until the workbook is saved. Writing row by row lets xlsxwriter stream
+    the sheet to disk. As with `to_excel`, missing values are left as blank cells.
+
+    Args:
+        df (object): A pandas dataframe
+        wb_path (str): Where to save the workbook
+        sheet_name (str): The name of the sheet to write to
+    """
+    wb = xlsxwriter.Workbook(str(wb_path), REPORT_XL_WB_OPTIONS)
+    try:
+        ws = wb.add_worksheet(sheet_name)
+        ws.write_row(0, 0, list(df.columns))
+        for row_num, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            ws.write_row(
+                row_num,
+                0,
+                [
+                    None if isinstance(value, float) and isnan(value) else value
+                    for value in row
+                ],
+            )
+    finally:
+        wb.close()
+
+
+def iter_df_records(df):
+    """Lazily yield each row of `df` as a dict keyed by column name
+
+    Unlike `df.to_dict(orient="records")`, this doesn't build every row dict up front.
+    """
+    columns = list(df.columns)
+    for row in df.itertuples(index=False, name=None):
+        yield dict(zip(columns, row))
 
 
 def main_with_args(
@@ -58,6 +130,7 @@ def main_with_args(
     prompt_user=True,
     rename_columns=None,
     required_one_ofs=None,
+    max_workers=DEFAULT_UPLOAD_MAX_WORKERS,
     **contact_kwargs,
 ):
     """The main routine. Create CommCare contacts based on legacy contact data.
@@ -95,6 +168,8 @@ def main_with_args(
             names.
         required_one_ofs (list): Optional. A list of columns from which at least one
             must have a valid, non-null value per row
+        max_workers (int): Optional. The maximum number of contact batches to upload
+            to CommCare concurrently.
         contact_kwargs (dict): Optional key/value pairs that will be added to each
             generated contact.
     """
@@ -114,16 +189,17 @@ def main_with_args(
 
     # Pandas infers data types, and that's not helpful in this context. For validation
     # and normalization purposes, we need all inputs to be strings.
-    # The main script wants a CSV file, but users may supply Excel wbs. If wb supplied
-    # we convert the `contacts` sheet into a CSV string IO
-    case_data_file = (
-        legacy_case_data_path
-        if legacy_case_data_path.endswith(".csv")
-        else convert_xl_wb_to_csv_string_io(legacy_case_data_path)
-    )
-
-    # avoid unexpected data type conversions. we just treat everything as string.
-    raw_case_data_df = pd.read_csv(case_data_file, keep_default_na=False, dtype=str)
+    # Users may supply either a CSV or an Excel wb. If wb supplied, we build the frame
+    # straight from the `contacts` sheet.
+    if legacy_case_data_path.endswith(".csv"):
+        # avoid unexpected data type conversions. we just treat everything as string.
+        # With `na_filter=False` the parser doesn't scan for NA markers at all, so
+        # empty cells come through as empty strings.
+        raw_case_data_df = pd.read_csv(
+            legacy_case_data_path, keep_default_na=False, dtype=str, na_filter=False
+        )
+    else:
+        raw_case_data_df = load_xl_wb_sheet_as_df(legacy_case_data_path)
     if rename_columns:
         col_map_string = ", ".join([f"{k} -> {v}" for (k, v) in rename_columns.items()])
         logger.info(f"Renaming columns: {col_map_string}")
@@ -133,13 +209,8 @@ def main_with_args(
     if (
         validate_case_data_columns(
             raw_case_data_df.columns,
-            data_dict.keys(),
-            [
-                key
-                for key in data_dict
-                if data_dict[key]["required"]
-                in ("true", "True", "TRUE", True, 1, "1", "yes", "Yes", "YES", "y", "Y")
-            ],
+            set(data_dict),
+            frozenset(key for key, val in data_dict.items() if val["required"]),
         )
         is False
     ):
@@ -160,23 +231,24 @@ def main_with_args(
     logger.info(
         "Validating row values in legacy contact data CSV against data dictionary"
     )
+    # both reports share the input file's stem and a single timestamp
+    report_dir = Path(reporting_path)
+    case_data_stem = Path(legacy_case_data_path).stem
     now_string = datetime.now().strftime("%m-%d-%Y_%H-%M")
     validation_report_name = (
-        f"{Path(legacy_case_data_path).stem}_{VALIDATION_REPORT_FILE_NAME_PART}_"
-        f"{now_string}.xlsx"
+        f"{case_data_stem}_{VALIDATION_REPORT_FILE_NAME_PART}_{now_string}.xlsx"
     )
-    validation_report_path = PurePath(reporting_path).joinpath(validation_report_name)
-    report_df = raw_case_data_df.merge(
-        case_data_df[["is_valid", "validation_problems"]],
-        left_index=True,
-        right_index=True,
+    validation_report_path = report_dir / validation_report_name
+    # `case_data_df` is derived row-for-row from `raw_case_data_df`, so the
+    # validation columns can be attached positionally without a merge.
+    report_df = raw_case_data_df.assign(
+        is_valid=case_data_df["is_valid"].to_numpy(),
+        validation_problems=case_data_df["validation_problems"].to_numpy(),
     )
     logger.info(f"Generating validation report at {validation_report_path}")
-    report_df.to_excel(
-        validation_report_path, index=False, sheet_name=WB_CONTACT_SHEET_NAME
-    )
-    num_invalid = len(case_data_df[~case_data_df["is_valid"]])
-    if not case_data_df["is_valid"].all() and reject_all_if_any_invalid_rows:
+    write_df_to_xl_wb(report_df, validation_report_path)
+    num_invalid = int((~case_data_df["is_valid"]).sum())
+    if num_invalid and reject_all_if_any_invalid_rows:
         msg = (
             f"{num_invalid} rows were invalid and `reject_all_if_any_invalid_rows` "
             f"is True. No case data will be uploaded. See details in the validation "
@@ -188,9 +260,9 @@ def main_with_args(
     # We generate this value in this context as it allows us to match up our original
     # data with results from the CommCare API and produce a report in which we
     # provide links to created contacts
-    case_data_df["contact_id"] = case_data_df.apply(
-        lambda row: generate_commcare_external_id(), axis=1
-    )
+    case_data_df["contact_id"] = [
+        generate_commcare_external_id() for _ in range(len(case_data_df))
+    ]
     valid_df = case_data_df[case_data_df["is_valid"]].drop(
         ["is_valid", "validation_problems"], axis=1
     )
@@ -204,9 +276,13 @@ def main_with_args(
             "Generating `name` property from `first_name`, `last_name`, and "
             "`contact_id`"
         )
-        normalized_case_data_df["name"] = normalized_case_data_df.apply(
-            lambda row: f"{row['first_name']} {row['last_name']} ({row['contact_id']})",
-            axis=1,
+        normalized_case_data_df["name"] = (
+            normalized_case_data_df["first_name"]
+            + " "
+            + normalized_case_data_df["last_name"]
+            + " ("
+            + normalized_case_data_df["contact_id"]
+            + ")"
         )
     if prompt_user:
         while True:
@@ -221,50 +297,49 @@ def main_with_args(
 
     logger.info("Attempting to upload contacts to CommCare")
     created_contacts_dict = upload_legacy_contacts_to_commcare(
-        normalized_case_data_df.to_dict(orient="records"),
+        iter_df_records(normalized_case_data_df),
         commcare_project_name,
         commcare_user_name,
         commcare_api_key,
+        max_workers=max_workers,
+        num_contacts=len(normalized_case_data_df),
         **contact_kwargs,
     )
     normalized_case_data_df["contact_creation_success"] = normalized_case_data_df[
         "contact_id"
-    ].apply(lambda val: val in created_contacts_dict.keys())
-
-    # this would be a lambda but didn't readably fit in one line
-    def _generate_contact_case_url_col_values(row, created_contacts_dict):
-        if row["contact_creation_success"] is False:
-            return ""
-        else:
-            return generate_commcare_case_report_url(
-                created_contacts_dict[row["contact_id"]], commcare_project_name
-            )
+    ].isin(created_contacts_dict)
 
-    normalized_case_data_df[
-        "commcare_contact_case_url"
-    ] = normalized_case_data_df.apply(
-        _generate_contact_case_url_col_values,
-        created_contacts_dict=created_contacts_dict,
-        axis=1,
-    )
+    normalized_case_data_df["commcare_contact_case_url"] = [
+        generate_commcare_case_report_url(
+            created_contacts_dict[contact_id], commcare_project_name
+        )
+        if success
+        else ""
+        for success, contact_id in zip(
+            normalized_case_data_df["contact_creation_success"],
+            normalized_case_data_df["contact_id"],
+        )
+    ]
     # generate a final frame that combines original contact data along with
     # columns we generated indicating if upload was successful and url to CommCare
     # contact.
-    final_df = case_data_df.merge(
-        normalized_case_data_df[
-            ["contact_creation_success", "commcare_contact_case_url", "contact_id"]
-        ],
-        how="left",
-        on="contact_id",
+    # `contact_id` is unique per row, so a lookup by it stands in for a left join.
+    upload_results_df = normalized_case_data_df.set_index("contact_id")
+    final_df = case_data_df.assign(
+        contact_creation_success=case_data_df["contact_id"].map(
+            upload_results_df["contact_creation_success"]
+        ),
+        commcare_contact_case_url=case_data_df["contact_id"].map(
+            upload_results_df["commcare_contact_case_url"]
+        ),
     )
     final_report_name = (
-        f"{Path(legacy_case_data_path).stem}_{FINAL_REPORT_FILE_NAME_PART}_"
-        f"{now_string}.xlsx"
+        f"{case_data_stem}_{FINAL_REPORT_FILE_NAME_PART}_{now_string}.xlsx"
     )
-    final_report_path = PurePath(reporting_path).joinpath(final_report_name)
+    final_report_path = report_dir / final_report_name
     final_df.drop(["contact_id"], inplace=True, axis=1)
     logger.info(f"Generating a final report at {final_report_path}")
-    final_df.to_excel(final_report_path, index=False, sheet_name=WB_CONTACT_SHEET_NAME)
+    write_df_to_xl_wb(final_df, final_report_path)
     logger.info("I am quite done now.")
 
 
@@ -312,6 +387,13 @@ def main():
         dest="contact_kwargs",
         type=json.loads,
     )
+    parser.add_argument(
+        "--maxWorkers",
+        help="The maximum number of contact batches to upload to CommCare at once",
+        dest="max_workers",
+        type=int,
+        default=DEFAULT_UPLOAD_MAX_WORKERS,
+    )
     args = parser.parse_args()
     try:
         main_with_args(
@@ -322,6 +404,7 @@ def main():
             args.data_dictionary_path,
             args.reporting_path,
             required_one_ofs=args.required_one_ofs,
+            max_workers=args.max_workers,
             **args.contact_kwargs,
         )
     except Exception:
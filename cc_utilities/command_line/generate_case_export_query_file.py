@@ -1,5 +1,6 @@
 import argparse
 import json
+import os
 import re
 from collections import defaultdict
 from datetime import datetime
@@ -7,7 +8,7 @@ from pathlib import Path
 
 from openpyxl import load_workbook
 
-from cc_utilities.common import make_commcare_export_sync_xl_wb, make_sql_friendly
+from cc_utilities.common import make_sql_friendly, write_commcare_export_sync_xl_wb
 from cc_utilities.logger import logger
 
 VALID_PROPERTY_NAME = re.compile(r"[\w-]+")
@@ -36,6 +37,7 @@ STATIC_CASE_FIELDS = [
     "server_date_opened",
     "user_id",
 ]
+STATIC_CASE_FIELDS_SET = frozenset(STATIC_CASE_FIELDS)
 
 # The CommCare API documentation also includes several "special case properties"
 # which appear to be standard for cases, but do require the "properties." prefix.
@@ -47,6 +49,7 @@ SPECIAL_CASE_PROPERTIES = [
     "case_type",
     "date_opened",
 ]
+SPECIAL_CASE_PROPERTIES_SET = frozenset(SPECIAL_CASE_PROPERTIES)
 
 
 def extract_property_names(case_summary_file, case_types):
@@ -59,22 +62,32 @@ def extract_property_names(case_summary_file, case_types):
     Returns:
         iterator: Iterator of strings of property names
     """
-    wb = load_workbook(filename=case_summary_file)
-    # iterate through columns A & B, by row
-    rows = zip(*wb["All Case Properties"]["A:B"])
-    # read the first (header) row
-    header_a, header_b = next(rows)
-    assert header_a.value == "case_type"
-    assert header_b.value == "case_property"
-    # read the remaining rows, filtering out any case types we're not looking for
-    # and case properties that are not valid XML entities (they are likely
-    # "calculated properties" without a property name in the CommCare app)
-    properties_by_type = defaultdict(list)
-    for case_type, case_property in rows:
-        case_type = case_type.value.strip()
-        case_property = case_property.value.strip()
-        if case_type in case_types and VALID_PROPERTY_NAME.fullmatch(case_property):
-            properties_by_type[case_type].append(case_property)
+    # read-only mode streams rows rather than loading every cell of the workbook
+    wb = load_workbook(filename=case_summary_file, read_only=True)
+    try:
+        # iterate through columns A & B, by row
+        rows = wb["All Case Properties"].iter_rows(min_row=1, max_col=2)
+        # read the first (header) row
+        header_a, header_b = next(rows)
+        assert header_a.value == "case_type"
+        assert header_b.value == "case_property"
+        # read the remaining rows, filtering out any case types we're not looking for
+        # and case properties that are not valid XML entities (they are likely
+        # "calculated properties" without a property name in the CommCare app)
+        properties_by_type = defaultdict(list)
+        case_types = frozenset(case_types)
+        for case_type_cell, case_property_cell in rows:
+            # skip blank rows, and only strip the property of rows we're keeping
+            if case_type_cell.value is None:
+                continue
+            case_type = case_type_cell.value.strip()
+            if case_type not in case_types:
+                continue
+            case_property = (case_property_cell.value or "").strip()
+            if VALID_PROPERTY_NAME.fullmatch(case_property):
+                properties_by_type[case_type].append(case_property)
+    finally:
+        wb.close()
     return properties_by_type
 
 
@@ -88,26 +101,30 @@ def generate_source_target_mappings(source_columns):
     Returns:
         list: List of tuples where item[0] is source name, and item[1] is target name
     """
+    # SPECIAL_CASE_PROPERTIES and STATIC_CASE_FIELDS don't overlap, so the only
+    # filtering needed is on the app-specific properties, before they're sorted.
     property_names = SPECIAL_CASE_PROPERTIES + sorted(
-        prop for prop in source_columns if prop not in SPECIAL_CASE_PROPERTIES
+        prop
+        for prop in source_columns
+        if prop not in SPECIAL_CASE_PROPERTIES_SET
+        and prop not in STATIC_CASE_FIELDS_SET
     )
     return [(source_col, source_col) for source_col in STATIC_CASE_FIELDS] + [
         (f"properties.{source_col}", make_sql_friendly(source_col))
         for source_col in property_names
-        if source_col not in STATIC_CASE_FIELDS
     ]
 
 
 def get_previous_mapping(state_dir, case_type):
     """Get the previous state of source-target column mappings from a JSON file
     Args:
-        state_dir (str): Path to the directory where JSON files were stored
+        state_dir (Path): Path to the directory where JSON files were stored
         case_type (str): This is the commcare case type
     Returns:
         mappings (list): List of tuples of form
             ("source_name", "target_name)
     """
-    state_path = Path(state_dir).joinpath(f"{case_type}-column-state.json")
+    state_path = state_dir / f"{case_type}-column-state.json"
     if state_path.exists():
         with open(state_path) as f:
             state = json.load(f)
@@ -126,24 +143,23 @@ def get_previous_mapping(state_dir, case_type):
 def save_column_state(state_dir, case_type, mappings):
     """Save the state of source-target column mappings in a JSON file
     Args:
-        state_dir (str): Directory where the state file will be saved
+        state_dir (Path): Existing directory where the state file will be saved
         case_type (str): This is the commcare case type
         mappings (list): List of tuples of form
             ("source_name", "target_name)
     Returns: No return, but saves json file to save_path
     """
-    state_dir = Path(state_dir)
-    state_dir.mkdir(parents=True, exist_ok=True)
-    state_path = state_dir.joinpath(f"{case_type}-column-state.json")
+    state_path = state_dir / f"{case_type}-column-state.json"
     state = {
         "case_type": case_type,
         "column_mappings": mappings,
         "as_of": datetime.now().strftime("%Y_%m_%d-%H_%M_%S"),
     }
-    with open(state_path, "w") as f:
-        json.dump(state, f, sort_keys=True, indent=2)
-        # Add missing newline at end of file.
-        f.write("\n")
+    # Write to a temporary file and move it into place, so an interrupted run can't
+    # leave a truncated state file behind. Add missing newline at end of file.
+    tmp_path = state_path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(state, sort_keys=True, indent=2) + "\n")
+    os.replace(tmp_path, state_path)
 
 
 def main_with_args(case_summary_file, case_types, output_file_path, state_dir):
@@ -162,6 +178,8 @@ def main_with_args(case_summary_file, case_types, output_file_path, state_dir):
     }
 
     if state_dir:
+        state_dir = Path(state_dir)
+        state_dir.mkdir(parents=True, exist_ok=True)
         for case_type, new_mapping in new_mappings.items():
             previous_mapping = get_previous_mapping(state_dir, case_type)
             if set(previous_mapping) != set(new_mapping):
@@ -169,8 +187,7 @@ def main_with_args(case_summary_file, case_types, output_file_path, state_dir):
 
     logger.info(f"Generating a temporary Excel workbook to {output_file_path}")
     new_mappings = {make_sql_friendly(k): v for (k, v) in new_mappings.items()}
-    wb = make_commcare_export_sync_xl_wb(new_mappings)
-    wb.save(output_file_path)
+    write_commcare_export_sync_xl_wb(new_mappings, output_file_path)
 
 
 def main():
@@ -1,12 +1,26 @@
 import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from math import ceil
 
-from cc_utilities.common import chunk_list, upload_data_to_commcare
+from cc_utilities.common import (
+    CommCareUtilitiesError,
+    chunk_list,
+    get_commcare_cases,
+    upload_data_to_commcare,
+)
 from cc_utilities.logger import logger
 from cc_utilities.twilio_lookup import (
+    DEFAULT_LOOKUP_MAX_WORKERS,
+    DEFAULT_LOOKUP_REQUESTS_PER_SECOND,
+    TwilioLookUpError,
     add_bad_ids,
+    check_twilio_credentials,
     cleanup_processed_records_with_numbers,
-    get_unprocessed_phone_numbers,
+    close_twilio_sessions,
+    count_unprocessed_phone_numbers,
+    iter_unprocessed_phone_numbers,
     process_records,
 )
 
@@ -21,6 +35,9 @@ def main_with_args(
     case_type,
     search_column,
     batch_size=100,
+    max_workers=DEFAULT_LOOKUP_MAX_WORKERS,
+    twilio_requests_per_second=DEFAULT_LOOKUP_REQUESTS_PER_SECOND,
+    upload_batch_size=None,
 ):
     """The main routine
 
@@ -39,61 +56,129 @@ def main_with_args(
         batch_size (int): The size to batch process requests in. Each batch_size batch
             will be looked up in Twilio, and then script attempts to upload the
             results for that batch to CommCare, before moving on to next batch.
+        upload_batch_size (int): Optional. Collect lookup results from several
+            batches and upload them to CommCare together once there are at least
+            this many. Defaults to `batch_size`, i.e. one upload per batch. Note that
+            IDs are only recorded as bad when no row in an upload matches a CommCare
+            case, so larger uploads make that check coarser.
+        max_workers (int): The maximum number of Twilio lookups to make at a time.
+        twilio_requests_per_second (int): The maximum number of Twilio lookups to
+            start each second.
 
     """
-    unprocessed = get_unprocessed_phone_numbers(db_url, case_type, search_column)
-    logger.info(f"{len(unprocessed)} unprocessed {case_type}(s) found")
-    expected_batches = ceil(len(unprocessed) / batch_size)
+    # Check both sets of credentials up front, rather than finding out about a bad
+    # one part way through a run.
+    try:
+        check_twilio_credentials(twilio_sid, twilio_token)
+        get_commcare_cases(
+            commcare_project_name,
+            commcare_user_name,
+            commcare_api_key,
+            case_type=case_type,
+            limit=1,
+        )
+    except (TwilioLookUpError, CommCareUtilitiesError) as exc:
+        logger.error(f"Could not authenticate with Twilio or CommCare: {exc}")
+        sys.exit(2)
+    num_unprocessed = count_unprocessed_phone_numbers(db_url, case_type, search_column)
+    logger.info(f"{num_unprocessed} unprocessed {case_type}(s) found")
+    expected_batches = ceil(num_unprocessed / batch_size)
+    # rows are streamed from the db a batch at a time and batched as they arrive
+    unprocessed = iter_unprocessed_phone_numbers(
+        db_url, case_type, search_column, fetch_size=batch_size
+    )
     logger.info(
         f"Processing {case_type}(s) in {expected_batches} "
         f"{'batch' if expected_batches == 1 else 'batches'} of {batch_size} {case_type}(s) "
         f"per batch."
     )
-    for i, subset in enumerate(chunk_list(unprocessed, batch_size)):
-        batch_num = i + 1
+
+    upload_batch_size = upload_batch_size if upload_batch_size else batch_size
+    pending_upload = None
+
+    def _finish_upload():
+        upload, contacts_data = pending_upload
+        response_json = upload.result()
+        if response_json["result"]["match_count"] == 0:
+            # We tried to upload >= 1 record but no matches were found in CommCare.
+            # Record those IDs so we can ignore them later.
+            bad_ids = [r["id"] for r in contacts_data]
+            logger.info("Adding bad CommCare IDs to sqlite3 state DB: %s", bad_ids)
+            add_bad_ids(case_type, bad_ids)
+
+    def _start_upload(contacts_data, batch_num):
+        nonlocal pending_upload
+        if pending_upload:
+            _finish_upload()
         logger.info(
-            f"Processing batch {batch_num} of {expected_batches} consisting of "
-            f"{len(subset)} {case_type}(s)."
+            "Uploading SMS capability status for %d %s(s) through batch %d of %d to "
+            "CommCare.",
+            len(contacts_data),
+            case_type,
+            batch_num,
+            expected_batches,
+        )
+        upload = upload_executor.submit(
+            upload_data_to_commcare,
+            contacts_data,
+            commcare_project_name,
+            case_type,
+            search_column,
+            commcare_user_name,
+            commcare_api_key,
+            "off",
+            file_name_prefix="twilio_sms_capability_",
         )
-        try:
+        pending_upload = (upload, contacts_data)
+
+    # Lookup results are collected until there are `upload_batch_size` of them. Each
+    # upload then runs in the background while the next batches are looked up in
+    # Twilio. Only one upload is in flight at a time. The lookup threads (and so
+    # their Twilio sessions and connections) are kept for the whole run, and their
+    # sessions closed once they are done.
+    to_upload = []
+    with ExitStack() as stack:
+        stack.callback(close_twilio_sessions)
+        lookup_executor = stack.enter_context(
+            ThreadPoolExecutor(max_workers=max_workers)
+        )
+        upload_executor = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+        for i, subset in enumerate(chunk_list(unprocessed, batch_size)):
+            batch_num = i + 1
+            logger.info(
+                "Processing batch %d of %d consisting of %d %s(s).",
+                batch_num,
+                expected_batches,
+                len(subset),
+                case_type,
+            )
             contacts_data = cleanup_processed_records_with_numbers(
                 process_records(
                     subset,
                     search_column,
                     twilio_sid,
                     twilio_token,
+                    requests_per_second=twilio_requests_per_second,
+                    executor=lookup_executor,
                 )
             )
-        except Exception as exc:
-            logger.error(f"Something unexpected happened: {exc.message}")
-            raise exc
 
-        if len(contacts_data) > 0:
-            logger.info(
-                f"Uploading SMS capability status for {len(contacts_data)} {case_type}(s) from "
-                f"batch {batch_num} of {expected_batches} to CommCare."
-            )
-            response_json = upload_data_to_commcare(
-                contacts_data,
-                commcare_project_name,
-                case_type,
-                search_column,
-                commcare_user_name,
-                commcare_api_key,
-                "off",
-                file_name_prefix="twilio_sms_capability_",
-            )
-            if response_json["result"]["match_count"] == 0:
-                # We tried to upload >= 1 record but no matches were found in CommCare.
-                # Record those IDs so we can ignore them later.
-                bad_ids = [r["id"] for r in contacts_data]
-                logger.info(f"Adding bad CommCare IDs to sqlite3 state DB: {bad_ids}")
-                add_bad_ids(case_type, bad_ids)
-        else:
-            logger.info(
-                f"Skipping upload because there are no {case_type}s "
-                f"in batch {batch_num} of {expected_batches}."
-            )
+            if len(contacts_data) == 0:
+                logger.info(
+                    "Skipping upload because there are no %ss in batch %d of %d.",
+                    case_type,
+                    batch_num,
+                    expected_batches,
+                )
+                continue
+            to_upload.extend(contacts_data)
+            if len(to_upload) >= upload_batch_size:
+                _start_upload(to_upload, batch_num)
+                to_upload = []
+        if to_upload:
+            _start_upload(to_upload, batch_num)
+        if pending_upload:
+            _finish_upload()
 
 
 def main():
@@ -124,14 +209,51 @@ def main():
         help="The column in db that will be matched as ID against Commcare's ID",
         default="id",
     )
-    args = parser.parse_args()
-    main_with_args(
-        args.db_url,
-        args.commcare_user_name,
-        args.commcare_api_key,
-        args.commcare_project_name,
-        args.twilio_sid,
-        args.twilio_token,
-        args.case_type,
-        args.search_column,
+    parser.add_argument(
+        "--max-workers",
+        help="The maximum number of Twilio lookups to make at a time",
+        dest="max_workers",
+        type=int,
+        default=DEFAULT_LOOKUP_MAX_WORKERS,
     )
+    parser.add_argument(
+        "--twilio-rps",
+        help="The maximum number of Twilio lookups to start each second",
+        dest="twilio_requests_per_second",
+        type=int,
+        default=DEFAULT_LOOKUP_REQUESTS_PER_SECOND,
+    )
+    parser.add_argument(
+        "--upload-batch-size",
+        help="Upload lookup results to CommCare once at least this many have been "
+        "collected (defaults to one upload per lookup batch)",
+        dest="upload_batch_size",
+        type=int,
+    )
+    args = parser.parse_args()
+    if args.max_workers < 1:
+        parser.error("--max-workers must be a positive integer")
+    if args.twilio_requests_per_second < 1:
+        parser.error("--twilio-rps must be a positive integer")
+    if args.upload_batch_size is not None and args.upload_batch_size < 1:
+        parser.error("--upload-batch-size must be a positive integer")
+    try:
+        main_with_args(
+            args.db_url,
+            args.commcare_user_name,
+            args.commcare_api_key,
+            args.commcare_project_name,
+            args.twilio_sid,
+            args.twilio_token,
+            args.case_type,
+            args.search_column,
+            max_workers=args.max_workers,
+            twilio_requests_per_second=args.twilio_requests_per_second,
+            upload_batch_size=args.upload_batch_size,
+        )
+    except Exception:
+        logger.exception(
+            "[process_numbers_for_sms_capability.main] Something went wrong"
+        )
+        sys.exit(1)
+    sys.exit(0)
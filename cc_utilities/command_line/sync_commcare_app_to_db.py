@@ -1,23 +1,33 @@
 import argparse
+import hashlib
 import json
+import os
+import shutil
 import subprocess
 import sys
 import tempfile
+import time
+from collections import defaultdict
 from datetime import datetime
-from pathlib import PurePath
+from itertools import chain
+from pathlib import Path, PurePath
+
+from sqlalchemy import create_engine
 
 from cc_utilities.common import (
-    get_application_structure,
-    make_commcare_export_sync_xl_wb,
+    get_application_structure_if_modified,
     make_sql_friendly,
+    write_commcare_export_sync_xl_wb,
 )
 from cc_utilities.constants import (
     APPLICATION_STRUCTURE_DEFAULT_TIMEOUT,
     COMMCARE_DEFAULT_HIDDEN_FIELD_MAPPINGS,
 )
-from cc_utilities.logger import get_full_log_file_path, logger
+from cc_utilities.logger import logger
 
 PARENT_PROPERTY_PREFIX = "parent/"
+SHARED_MEMORY_DIR = "/dev/shm"
+DEFAULT_APP_STRUCTURE_CACHE_DIR = Path.home().joinpath(".cache", "cc_utilities")
 
 
 def do_commcare_export_to_db(
@@ -31,6 +41,9 @@ def do_commcare_export_to_db(
 ):
     """Run `commcare-export` as subprocess to export data to SQL db
 
+    The subprocess's output is logged as it is produced. Raises
+    `subprocess.CalledProcessError` if the export fails.
+
     Args:
         database_url_string (str): Full db url to export to
         commcare_project_name (str): The Commcare project being exported from
@@ -48,27 +61,59 @@ def do_commcare_export_to_db(
     commcare_export_script_flags = (
         commcare_export_script_flags if commcare_export_script_flags else []
     )
-    commands = (
-        f"commcare-export --output-format sql "
-        f"--output {database_url_string} --project {commcare_project_name} "
-        f"--query {wb_file_path} --username {commcare_user_name} "
-        f"--auth-mode apikey --password {commcare_api_key}"
+    # build the argument list directly (rather than splitting a string) so values
+    # containing spaces are passed through intact
+    commands = [
+        "commcare-export",
+        "--output-format",
+        "sql",
+        "--output",
+        database_url_string,
+        "--project",
+        commcare_project_name,
+        "--query",
+        str(wb_file_path),
+        "--username",
+        commcare_user_name,
+        "--auth-mode",
+        "apikey",
+        "--password",
+        commcare_api_key,
+    ]
+    for k, v in commcare_export_script_options.items():
+        commands.extend([f"--{k}", str(v)])
+    commands.extend([f"--{flag}" for flag in commcare_export_script_flags])
+    # forward the export's output through our logger line by line as it arrives, so
+    # progress on long exports shows up right away (and in the log file, if one is
+    # configured). PYTHONUNBUFFERED keeps the child from buffering its output.
+    process = subprocess.Popen(
+        commands,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        bufsize=1,
+        env={**os.environ, "PYTHONUNBUFFERED": "1"},
     )
+    with process:
+        for line in process.stdout:
+            logger.info("[commcare-export] %s", line.rstrip())
+    if process.returncode:
+        # the full command includes the API key, so leave it out of the error
+        raise subprocess.CalledProcessError(process.returncode, commands[0])
 
-    additional_options = " ".join(
-        [f"--{k} {v}" for (k, v) in commcare_export_script_options.items()]
-    )
-    additional_flags = " ".join([f"--{flag}" for flag in commcare_export_script_flags])
-    commands = " ".join(
-        [i for i in (commands, additional_options, additional_flags) if i]
-    ).strip()
-    commands = commands.split(" ")
-    log_file_path = get_full_log_file_path()
-    if log_file_path:
-        with open(log_file_path, "a") as fl:
-            subprocess.run(commands, stderr=fl, stdout=fl)
-    else:
-        subprocess.run(commands)
+
+def check_db_connection(db_url):
+    """Make sure the db can be connected to before doing any slow work
+
+    Args:
+        db_url (str): Connection string for the db
+    """
+    engine = create_engine(db_url)
+    try:
+        with engine.connect():
+            pass
+    finally:
+        engine.dispose()
 
 
 def normalize_application_structure_response_data(response_json):
@@ -88,33 +133,23 @@ def normalize_application_structure_response_data(response_json):
                 "contact": ["first_name", "last_name", "phone_number", "etc".]
             }
     """
-    normalized = {}
+    normalized = defaultdict(set)
+    prefix_len = len(PARENT_PROPERTY_PREFIX)
     for module in response_json["modules"]:
+        case_type = module["case_type"]
         # oddly, there are module types that appear that don't have a case type
-        if not module["case_type"]:
+        if not case_type:
             continue
         # the same case type will appear in multiple modules (each version of the app)
-        # so we build up the total set of case types...
-        if not normalized.get(module["case_type"]):
-            normalized[module["case_type"]] = set(
-                [
-                    prop
-                    for prop in module["case_properties"]
-                    if not prop.startswith(PARENT_PROPERTY_PREFIX)
-                ]
-            )
-        else:
-            normalized[module["case_type"]] = normalized[module["case_type"]].union(
-                set(
-                    [
-                        prop
-                        for prop in module["case_properties"]
-                        # the app structure api returns a long list of properties
-                        # of parents of the given case type. we ignore these
-                        if not prop.startswith(PARENT_PROPERTY_PREFIX)
-                    ]
-                )
-            )
+        # so we build up the total set of case types. the app structure api also
+        # returns a long list of properties of parents of the given case type. we
+        # ignore these
+        normalized[case_type].update(
+            prop
+            for prop in module["case_properties"]
+            # a slice comparison is cheaper than calling `startswith`
+            if prop[:prefix_len] != PARENT_PROPERTY_PREFIX
+        )
     # convert the sets to lists at the end
     return {k: list(v) for (k, v) in normalized.items()}
 
@@ -132,11 +167,72 @@ def save_app_structure_json(structure, save_folder):
     """
     date_file_name = f"app_structure_{datetime.now().strftime('%m_%d_%Y_%H-%M')}.json"
     latest_file_name = "app_structure_latest.json"
-    for file_name in (date_file_name, latest_file_name):
-        full_path = PurePath(save_folder).joinpath(file_name)
-        logger.info(f"Saving normalized application structure data at {full_path}")
-        with open(full_path, "w") as fl:
-            json.dump(structure, fl)
+    date_file_path = PurePath(save_folder).joinpath(date_file_name)
+    latest_file_path = PurePath(save_folder).joinpath(latest_file_name)
+    logger.info(f"Saving normalized application structure data at {date_file_path}")
+    with open(date_file_path, "w") as fl:
+        json.dump(structure, fl)
+    # the structure is only serialized once; "latest" is a copy of the dated file
+    logger.info(f"Saving normalized application structure data at {latest_file_path}")
+    shutil.copyfile(date_file_path, latest_file_path)
+
+
+def get_app_structure_cache_path(cache_dir, commcare_project_name, commcare_app_id):
+    """Get the path of the cached application structure for a project and app
+
+    Args:
+        cache_dir (str): The folder where cached application structures are kept
+        commcare_project_name (str): The Commcare project name
+        commcare_app_id (str): The ID of the Commcare app.
+
+    Returns:
+        Path: The path to the cache file (which may not exist yet)
+    """
+    key = hashlib.sha256(
+        f"{commcare_project_name}:{commcare_app_id}".encode("utf-8")
+    ).hexdigest()[:16]
+    return Path(cache_dir).joinpath(f"app_structure_{key}.json")
+
+
+def load_cached_app_structure(cache_path):
+    """Load a cached application structure, if there is a usable one
+
+    Args:
+        cache_path (Path): The path returned by `get_app_structure_cache_path`
+
+    Returns:
+        dict: With "etag", "last_modified", and "structure" keys, or None if the
+            cache file is missing or unreadable.
+    """
+    try:
+        with open(cache_path) as fl:
+            cached = json.load(fl)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        logger.warning(f"Ignoring unreadable application structure cache {cache_path}")
+        return None
+    if not isinstance(cached, dict) or "structure" not in cached:
+        return None
+    return cached
+
+
+def save_cached_app_structure(cache_path, structure, etag=None, last_modified=None):
+    """Save a normalized application structure along with its HTTP validators
+
+    Args:
+        cache_path (Path): The path returned by `get_app_structure_cache_path`
+        structure (dict): The normalized application structure
+        etag (str): Optional. The `ETag` header of the response
+        last_modified (str): Optional. The `Last-Modified` header of the response
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as fl:
+        json.dump(
+            {"etag": etag, "last_modified": last_modified, "structure": structure}, fl
+        )
+    os.replace(tmp_path, cache_path)
 
 
 def get_app_case_types_with_properties_from_api(
@@ -146,10 +242,19 @@ def get_app_case_types_with_properties_from_api(
     commcare_app_id,
     app_structure_api_timeout,
     app_structure_json_save_folder_path=None,
+    app_structure_cache_dir=None,
+    app_structure_cache_ttl=None,
+    case_types=None,
 ):
     """Get data about each case type and its known properties (historical and current)
         from the Application Structure API.
 
+    If `app_structure_cache_dir` is provided, the normalized structure is cached there
+    along with the response's `ETag` / `Last-Modified` headers, and subsequent calls
+    make a conditional request, reusing the cached structure when the API answers
+    `304 Not Modified`. If the cached copy is younger than `app_structure_cache_ttl`
+    seconds (and has all of `case_types`), it is used without making a request at all.
+
     Args:
 
         commcare_user_name (str): The Commcare username (email address)
@@ -163,6 +268,13 @@ def get_app_case_types_with_properties_from_api(
         app_structure_json_save_folder_path (str): Optional. If provided, the JSON
             returned by the call to the Application Structure API will be saved as a
             JSON file in this folder.
+        app_structure_cache_dir (str): Optional. Folder in which to cache the
+            normalized application structure between runs.
+        app_structure_cache_ttl (int): Optional. Seconds for which a cached
+            application structure is used without checking the API for changes.
+        case_types (list): Optional. The case types that are going to be synced. A
+            cached copy that is missing any of these is always checked against the
+            API, since they may have been added to the app since it was cached.
     Returns:
         dict: Whose keys are case types and whose values are lists of property names.
             For instance {
@@ -170,18 +282,51 @@ def get_app_case_types_with_properties_from_api(
                 "contact": ["first_name", "last_name", "phone_number", "etc".]
             }
     """
+    cache_path = (
+        get_app_structure_cache_path(
+            app_structure_cache_dir, commcare_project_name, commcare_app_id
+        )
+        if app_structure_cache_dir
+        else None
+    )
+    cached = load_cached_app_structure(cache_path) if cache_path else None
+    if (
+        cached
+        and app_structure_cache_ttl
+        and time.time() - cache_path.stat().st_mtime < app_structure_cache_ttl
+        and cached["structure"].keys() >= set(case_types if case_types else [])
+    ):
+        logger.info(f"Using application structure cached at {cache_path}")
+        normalized_structure = cached["structure"]
+        if app_structure_json_save_folder_path:
+            save_app_structure_json(
+                normalized_structure, app_structure_json_save_folder_path
+            )
+        return normalized_structure
     logger.info(
         f"Retrieving application structure for {commcare_project_name} with ID: "
         f"{commcare_app_id} from API. This may take a while."
     )
-    app_structure = get_application_structure(
+    app_structure, validators = get_application_structure_if_modified(
         commcare_project_name,
         commcare_user_name,
         commcare_api_key,
         commcare_app_id,
         app_structure_api_timeout,
+        etag=cached["etag"] if cached else None,
+        last_modified=cached["last_modified"] if cached else None,
     )
-    normalized_structure = normalize_application_structure_response_data(app_structure)
+    if app_structure is None and cached:
+        logger.info(f"Application structure unchanged; using cached copy {cache_path}")
+        normalized_structure = cached["structure"]
+        # restart the TTL clock now that the copy is known to be current
+        cache_path.touch()
+    else:
+        normalized_structure = normalize_application_structure_response_data(
+            app_structure
+        )
+        if cache_path:
+            save_cached_app_structure(cache_path, normalized_structure, **validators)
     if app_structure_json_save_folder_path:
         save_app_structure_json(
             normalized_structure, app_structure_json_save_folder_path
@@ -231,15 +376,16 @@ def generate_source_field_to_target_column_mappings(case_types_with_properties):
     """
     source_to_target_mappings = {}
     for case_type in case_types_with_properties:
+        # dict.fromkeys de-duplicates while keeping the mappings in order
         source_to_target_mappings[make_sql_friendly(case_type)] = list(
-            set(
-                [
-                    *COMMCARE_DEFAULT_HIDDEN_FIELD_MAPPINGS,
-                    *[
+            dict.fromkeys(
+                chain(
+                    COMMCARE_DEFAULT_HIDDEN_FIELD_MAPPINGS,
+                    (
                         (f"properties.{item}", make_sql_friendly(item))
                         for item in sorted(case_types_with_properties[case_type])
-                    ],
-                ]
+                    ),
+                )
             )
         )
     return source_to_target_mappings
@@ -257,6 +403,8 @@ def main_with_args(
     app_structure_api_timeout=None,
     commcare_export_script_options=None,
     commcare_export_script_flags=None,
+    app_structure_cache_dir=None,
+    app_structure_cache_ttl=None,
 ):
     """The main routine.
 
@@ -281,8 +429,16 @@ def main_with_args(
             get passed to the `commcare-export` subprocess as command line options.
         commcare_export_script_flags (list): Optional. A list of command line flags
             (with no args) to pass to `commcare-export` subprocess.
+        app_structure_cache_dir (str): Optional. Folder in which to cache the
+            normalized application structure between runs, so unchanged apps are
+            not re-downloaded.
+        app_structure_cache_ttl (int): Optional. Seconds for which a cached
+            application structure is used without checking the API for changes.
     """
     case_types = case_types if case_types else []
+    # the Application Structure API call can take minutes, so surface a bad db url
+    # before making it rather than after
+    check_db_connection(db_url)
 
     all_case_types_with_properties = (
         load_app_case_types_with_properties_from_json(existing_app_structure_json)
@@ -295,32 +451,34 @@ def main_with_args(
             commcare_app_id,
             app_structure_api_timeout,
             app_structure_json_save_folder_path,
+            app_structure_cache_dir,
+            app_structure_cache_ttl,
+            case_types,
         )
     )
     # if person running script used the `--case-types` property and some of the ones
     # they asked for weren't avaiable, we'll use this to notify them in the logs
-    unfound_requested_case_types = list(
-        set(case_types).difference(
-            set([k for k in all_case_types_with_properties.keys()])
-        )
-    )
-    if case_types and len(unfound_requested_case_types) == len(case_types):
-        logger.warn("None of the case types you requested were found")
+    requested_case_types = set(case_types)
+    # dict key views support set operations directly
+    available_case_types = all_case_types_with_properties.keys()
+    unfound_requested_case_types = sorted(requested_case_types - available_case_types)
+    if case_types and len(unfound_requested_case_types) == len(requested_case_types):
+        logger.warning("None of the case types you requested were found")
         return
     if unfound_requested_case_types:
-        logger.warn(
+        logger.warning(
             f"Some case types were not found: {', '.join(unfound_requested_case_types)}"
         )
         logger.info("Will continue processing the other requested case types")
     # we'll try to sync the requested case types minus the unfound ones if subset
     # requested, and if no subset requested, we'll sync all found case types
     to_sync_case_types = (
-        list(set(case_types).difference(set(unfound_requested_case_types)))
+        requested_case_types & available_case_types
         if case_types
-        else list(set([k for k in all_case_types_with_properties.keys()]))
+        else set(available_case_types)
     )
     # filter `all_case_types_with_properties` down to only ones that are in our
-    # list of `to_sync_case_types`
+    # set of `to_sync_case_types`
     to_sync_case_types_with_properties = {
         k: v
         for (k, v) in all_case_types_with_properties.items()
@@ -330,12 +488,14 @@ def main_with_args(
     mappings = generate_source_field_to_target_column_mappings(
         to_sync_case_types_with_properties
     )
-    # this excel wb file is required by commcare-export which gets called in subprocess
-    # by do_commcare_export_to_db
-    wb = make_commcare_export_sync_xl_wb(mappings)
-    with tempfile.TemporaryDirectory() as tmpdir:
+    # keep the workbook in memory-backed storage where available (e.g., on Linux) to
+    # keep disk I/O off the critical path
+    tmp_parent_dir = SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else None
+    with tempfile.TemporaryDirectory(dir=tmp_parent_dir) as tmpdir:
         tmp_file_path = PurePath(tmpdir).joinpath("mapping.xlsx")
-        wb.save(tmp_file_path)
+        # this excel wb file is required by commcare-export which gets called in
+        # subprocess by do_commcare_export_to_db
+        write_commcare_export_sync_xl_wb(mappings, tmp_file_path)
         logger.info("Attempting to sync to db")
         do_commcare_export_to_db(
             db_url,
@@ -401,7 +561,10 @@ def main():
     )
     parser.add_argument(
         "--case-types",
-        help="Optional. Comma-separated list of case types to sync",
+        help=(
+            "Optional. Space- or comma-separated list of case types to sync (e.g. "
+            "`--case-types contact patient` or `--case-types contact,patient`)"
+        ),
         nargs="*",
         default=[],
     )
@@ -425,6 +588,30 @@ def main():
         type=int,
         default=APPLICATION_STRUCTURE_DEFAULT_TIMEOUT,
     )
+    parser.add_argument(
+        "--app-structure-cache-dir",
+        help=(
+            "Optional. Folder in which to cache application structure data between "
+            "runs. The API is asked whether the app has changed and the cached data is "
+            f"reused if not. Defaults to {DEFAULT_APP_STRUCTURE_CACHE_DIR}"
+        ),
+        default=DEFAULT_APP_STRUCTURE_CACHE_DIR,
+    )
+    parser.add_argument(
+        "--app-structure-cache-ttl",
+        help=(
+            "Optional. Seconds for which cached application structure data is used "
+            "without asking the API whether the app has changed. Defaults to 0 "
+            "(always ask)."
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--no-app-structure-cache",
+        help="If flag included, always download the full application structure.",
+        action="store_true",
+    )
     parser.add_argument(
         "--since",
         help="Optional. Export all data after this date. Format YYYY-MM-DD",
@@ -437,8 +624,10 @@ def main():
         "--batch-size",
         help=(
             "Integer. Records will be streamed to the SQL "
-            "db in batches of this size. Defaults to 1000."
+            "db in batches of this size. Larger batches mean fewer round trips to "
+            "the db. Defaults to 5000."
         ),
+        type=int,
         default=5000,
     )
     parser.add_argument(
@@ -474,6 +663,15 @@ def main():
         action="store_true",
     )
     args = parser.parse_args()
+    # accept `a b`, `a,b`, and any mix of the two
+    case_types = [
+        case_type.strip()
+        for arg in args.case_types
+        for case_type in arg.split(",")
+        if case_type.strip()
+    ]
+    if args.batch_size < 1:
+        parser.error("--batch-size must be a positive integer")
     try:
         (
             additional_cc_export_options,
@@ -486,12 +684,16 @@ def main():
             args.commcare_project_name,
             args.application_id,
             args.db_url,
-            args.case_types,
+            case_types,
             args.existing_app_structure_json,
             args.app_structure_json_save_folder_path,
             args.app_structure_api_timeout,
             commcare_export_script_options=additional_cc_export_options,
             commcare_export_script_flags=additional_cc_export_flags,
+            app_structure_cache_dir=(
+                None if args.no_app_structure_cache else args.app_structure_cache_dir
+            ),
+            app_structure_cache_ttl=args.app_structure_cache_ttl,
         )
     except Exception:
         logger.exception("[sync_commcare_app_to_db.main] Something went wrong")
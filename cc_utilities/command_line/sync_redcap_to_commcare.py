@@ -1,15 +1,24 @@
 import argparse
 import os
-from datetime import datetime
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
-import redcap
 import yaml
 
+try:
+    import fcntl
+except ImportError:  # e.g., on Windows
+    fcntl = None
+
 from cc_utilities.constants import REDCAP_INTEGRATION_STATUS
 from cc_utilities.logger import logger
 from cc_utilities.redcap_sync import (
+    DEFAULT_REDCAP_EXPORT_CHUNK_SIZE,
+    DEFAULT_REDCAP_EXPORT_MAX_WORKERS,
     collapse_checkbox_columns,
     collapse_housing_fields,
+    export_records_chunked,
     handle_cdms_matching,
     normalize_date_cols,
     normalize_phone_cols,
@@ -24,6 +33,11 @@ from cc_utilities.redcap_sync import (
     upload_incomplete_records,
 )
 
+# Use PyYAML's libyaml bindings when it was built with them; they read and write the
+# same documents as the pure-Python loader and dumper.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CDumper", yaml.Dumper)
+
 
 def get_redcap_state(state_file):
     "Read state required for REDCap sync."
@@ -33,13 +47,41 @@ def get_redcap_state(state_file):
             "in_progress": False,
         }
     with open(state_file) as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=YAML_LOADER)
 
 
 def save_redcap_state(state, state_file):
     "Save state required for REDCap sync."
-    with open(state_file, "w") as f:
-        yaml.dump(state, f)
+    # Write to a temporary file and move it into place, so a crash part way through
+    # a write can't leave a truncated state file behind.
+    tmp_state_file = f"{state_file}.tmp"
+    with open(tmp_state_file, "w") as f:
+        yaml.dump(state, f, Dumper=YAML_DUMPER)
+    os.replace(tmp_state_file, state_file)
+
+
+@contextmanager
+def redcap_sync_lock(state_file):
+    """
+    Hold an exclusive advisory lock on a `.lock` file next to `state_file` for the
+    duration of the sync, raising ValueError if another process already holds it.
+
+    The OS releases the lock if the process dies, so unlike the `in_progress` flag
+    in the state file it can't be left stale. Yields True if the lock was taken, or
+    False on platforms without `fcntl` (e.g., Windows).
+    """
+    if fcntl is None:
+        yield False
+        return
+    with open(f"{state_file}.lock", "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ValueError("There may be another process running. Exiting.")
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
 def main_with_args(
@@ -55,6 +97,9 @@ def main_with_args(
     state_file,
     db_url,
     sync_all,
+    redcap_export_chunk_size=DEFAULT_REDCAP_EXPORT_CHUNK_SIZE,
+    redcap_export_max_workers=DEFAULT_REDCAP_EXPORT_MAX_WORKERS,
+    min_sync_interval=0,
 ):
     """
     Script to download case and contact records for the given `redcap_api_url` and
@@ -73,110 +118,127 @@ def main_with_args(
         state_file (str): File path to a local file where state about this sync can be kept
         db_url (str): the db connection URL to query for existing patients.
         sync_all (bool): If set, ignore the date_begin in the state_file and sync all records
+        redcap_export_chunk_size (int): The number of records to export from REDCap
+            per request
+        redcap_export_max_workers (int): The maximum number of REDCap export
+            requests to make at a time
+        min_sync_interval (int): If set, skip the sync (without contacting REDCap)
+            when the last successful sync started fewer than this many minutes ago.
+            Ignored with `sync_all`.
     """
 
-    # Try to avoid starting a second process, if one is already going
-    # (this approach is not free of race conditions, but should catch
-    # the majority of accidental duplicate runs).
-    state = get_redcap_state(state_file)
-    if state["in_progress"]:
-        raise ValueError("There may be another process running. Exiting.")
-    state["in_progress"] = True
-    save_redcap_state(state, state_file)
+    # Avoid starting a second process, if one is already going. Where file locks
+    # aren't available, fall back to the `in_progress` flag in the state file (this
+    # approach is not free of race conditions, but should catch the majority of
+    # accidental duplicate runs).
+    with redcap_sync_lock(state_file) as locked:
+        state = get_redcap_state(state_file)
+        if state["in_progress"]:
+            if not locked:
+                raise ValueError("There may be another process running. Exiting.")
+            logger.warning(
+                "The previous sync did not finish cleanly; continuing, since no "
+                "other sync holds the lock."
+            )
+        if (
+            min_sync_interval
+            and not sync_all
+            and state["date_begin"]
+            and datetime.now() - state["date_begin"]
+            < timedelta(minutes=min_sync_interval)
+        ):
+            logger.info(
+                f"Last sync started at {state['date_begin']}, less than "
+                f"{min_sync_interval} minute(s) ago; skipping sync."
+            )
+            return
+        state["in_progress"] = True
+        save_redcap_state(state, state_file)
 
-    try:
-        # Save next_date_begin before retrieving records so we don't miss any
-        # on the next run (this might mean some records are synced twice, but
-        # that's better than never at all).
-        next_date_begin = datetime.now()
+        try:
+            # Save next_date_begin before retrieving records so we don't miss any
+            # on the next run (this might mean some records are synced twice, but
+            # that's better than never at all).
+            next_date_begin = datetime.now()
 
-        logger.info("Retrieving and cleaning data from REDCap...")
-        redcap_project = redcap.Project(redcap_api_url, redcap_api_key)
-        redcap_records = redcap_project.export_records(
-            # date_begin corresponds to the dateRangeBegin field in the REDCap
-            # API, which "return[s] only records that have been created or modified
-            # *after* a given date/time." Note that REDCap expects this to be in
-            # server time, so the script and server should be run in the same time
-            # zone (or this script modified to accept a timezone argument).
-            date_begin=state["date_begin"] if not sync_all else None,
-            # Tell PyCap to return a pandas DataFrame.
-            format="df",
-            df_kwargs={
-                # Without index_col=False, read_csv() will use the first column
-                # ("record_id") as the index, which is problematic because it's
-                # not unique and is easier to handle as a separate column anyways.
-                "index_col": False,
-                # We import everything as a string, to avoid pandas coercing ints
-                # to floats and adding unnecessary decimal points in the data when
-                # uploaded to CommCare.
-                "dtype": str,
-            },
-            # Only retrieve records which have not already synced (either rejected or success),
-            # have a cdms_id, and with complete surveys.
-            filter_logic=" AND ".join(
-                [
-                    f"[{REDCAP_INTEGRATION_STATUS}] = ''",
-                    "[ci_survey_complete] = 2",
-                    f"[{external_id_col}] != ''",
-                ]
-            ),
-        )
-        if len(redcap_records.index) == 0:
-            logger.info("No records returned from REDCap; aborting sync.")
-        else:
-            logger.info(f"Found {len(redcap_records)} REDCap records to sync.")
-            complete_records, incomplete_records = (
-                # populate_symptom_columns must come before collapse_checkbox_columns, since
-                # it relies on the data structure of a set of checkboxes ("symptoms_selected")
-                # before it's collapsed
-                redcap_records.pipe(populate_symptom_columns)
-                .pipe(collapse_checkbox_columns)
-                .pipe(normalize_phone_cols, phone_cols)
-                .pipe(normalize_temperature_cols, temperature_cols)
-                .pipe(normalize_date_cols, date_cols)
-                .pipe(collapse_housing_fields)
-                .pipe(rename_fields)
-                .pipe(set_external_id_column, external_id_col)
-                .pipe(
-                    reject_records_already_filled_out_by_case_investigator,
-                    db_url,
-                    external_id_col,
+            logger.info("Retrieving and cleaning data from REDCap...")
+            redcap_records = export_records_chunked(
+                redcap_api_url,
+                redcap_api_key,
+                chunk_size=redcap_export_chunk_size,
+                max_workers=redcap_export_max_workers,
+                # date_begin corresponds to the dateRangeBegin field in the REDCap
+                # API, which "return[s] only records that have been created or modified
+                # *after* a given date/time." Note that REDCap expects this to be in
+                # server time, so the script and server should be run in the same time
+                # zone (or this script modified to accept a timezone argument).
+                date_begin=state["date_begin"] if not sync_all else None,
+                # Only retrieve records which have not already synced (either rejected
+                # or success), have a cdms_id, and with complete surveys.
+                filter_logic=" AND ".join(
+                    [
+                        f"[{REDCAP_INTEGRATION_STATUS}] = ''",
+                        "[ci_survey_complete] = 2",
+                        f"[{external_id_col}] != ''",
+                    ]
+                ),
+            )
+            if len(redcap_records.index) == 0:
+                logger.info("No records returned from REDCap; aborting sync.")
+            else:
+                logger.info(f"Found {len(redcap_records)} REDCap records to sync.")
+                complete_records, incomplete_records = (
+                    # populate_symptom_columns must come before
+                    # collapse_checkbox_columns, since it relies on the data structure
+                    # of a set of checkboxes ("symptoms_selected") before it's collapsed
+                    redcap_records.pipe(populate_symptom_columns)
+                    .pipe(collapse_checkbox_columns)
+                    .pipe(normalize_phone_cols, phone_cols)
+                    .pipe(normalize_temperature_cols, temperature_cols)
+                    .pipe(normalize_date_cols, date_cols)
+                    .pipe(collapse_housing_fields)
+                    .pipe(rename_fields)
+                    .pipe(set_external_id_column, external_id_col)
+                    .pipe(
+                        reject_records_already_filled_out_by_case_investigator,
+                        db_url,
+                        external_id_col,
+                        commcare_project_name,
+                        commcare_user_name,
+                        commcare_api_key,
+                        redcap_api_url,
+                        redcap_api_key,
+                    )
+                    .pipe(
+                        handle_cdms_matching,
+                        db_url,
+                        external_id_col,
+                        redcap_api_url,
+                        redcap_api_key,
+                    )
+                    .pipe(split_complete_and_incomplete_records)
+                )
+                upload_complete_records(
+                    complete_records,
+                    commcare_api_key,
                     commcare_project_name,
                     commcare_user_name,
+                )
+                upload_incomplete_records(
+                    incomplete_records,
                     commcare_api_key,
-                    redcap_api_url,
-                    redcap_api_key,
+                    commcare_project_name,
+                    commcare_user_name,
                 )
-                .pipe(
-                    handle_cdms_matching,
-                    db_url,
-                    external_id_col,
-                    redcap_api_url,
-                    redcap_api_key,
+                update_successful_records_in_redcap(
+                    complete_records, incomplete_records, redcap_api_url, redcap_api_key
                 )
-                .pipe(split_complete_and_incomplete_records)
-            )
-            upload_complete_records(
-                complete_records,
-                commcare_api_key,
-                commcare_project_name,
-                commcare_user_name,
-            )
-            upload_incomplete_records(
-                incomplete_records,
-                commcare_api_key,
-                commcare_project_name,
-                commcare_user_name,
-            )
-            update_successful_records_in_redcap(
-                complete_records, incomplete_records, redcap_api_url, redcap_api_key
-            )
-        state["date_begin"] = next_date_begin
-    finally:
-        # Whatever happens, don't keep our lock open.
-        state["in_progress"] = False
-        save_redcap_state(state, state_file)
-    logger.info("Sync done.")
+            state["date_begin"] = next_date_begin
+        finally:
+            # Whatever happens, don't keep our lock open.
+            state["in_progress"] = False
+            save_redcap_state(state, state_file)
+        logger.info("Sync done.")
 
 
 def main():
@@ -244,18 +306,44 @@ def main():
         help="If set, ignore the begin date in the state file and sync all records",
         action="store_true",
     )
-    args = parser.parse_args()
-    main_with_args(
-        args.commcare_user_name,
-        args.commcare_api_key,
-        args.commcare_project_name,
-        args.redcap_api_url,
-        args.redcap_api_key,
-        args.external_id_col,
-        args.phone_cols or [],
-        args.temperature_cols or [],
-        args.date_cols or [],
-        args.state_file,
-        args.db_url,
-        args.sync_all,
+    parser.add_argument(
+        "--redcap-export-chunk-size",
+        help="The number of records to export from REDCap per request",
+        type=int,
+        default=DEFAULT_REDCAP_EXPORT_CHUNK_SIZE,
+    )
+    parser.add_argument(
+        "--redcap-export-max-workers",
+        help="The maximum number of REDCap export requests to make at a time",
+        type=int,
+        default=DEFAULT_REDCAP_EXPORT_MAX_WORKERS,
+    )
+    parser.add_argument(
+        "--min-sync-interval",
+        help="Skip the sync if the last one started fewer than this many minutes ago",
+        type=int,
+        default=0,
     )
+    args = parser.parse_args()
+    try:
+        main_with_args(
+            args.commcare_user_name,
+            args.commcare_api_key,
+            args.commcare_project_name,
+            args.redcap_api_url,
+            args.redcap_api_key,
+            args.external_id_col,
+            args.phone_cols or [],
+            args.temperature_cols or [],
+            args.date_cols or [],
+            args.state_file,
+            args.db_url,
+            args.sync_all,
+            redcap_export_chunk_size=args.redcap_export_chunk_size,
+            redcap_export_max_workers=args.redcap_export_max_workers,
+            min_sync_interval=args.min_sync_interval,
+        )
+    except Exception:
+        logger.exception("[sync_redcap_to_commcare.main] Something went wrong")
+        sys.exit(1)
+    sys.exit(0)
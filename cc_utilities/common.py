@@ -1,10 +1,14 @@
 import re
+import threading
 import time
+from functools import lru_cache
+from itertools import islice
 from math import log2
 from urllib.parse import urljoin
 
 import pandas as pd
 import requests
+import xlsxwriter
 from openpyxl import Workbook
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
@@ -20,6 +24,8 @@ from .constants import (
 from .logger import logger
 
 MAX_RETRY_DELAY = 512
+# Per-thread requests sessions for CommCare uploads. See get_commcare_upload_session().
+_commcare_upload_sessions = threading.local()
 
 
 class CommCareUtilitiesError(Exception):
@@ -33,24 +39,13 @@ class NoCommCareCasesReturned(Exception):
         super(NoCommCareCasesReturned, self).__init__(message)
 
 
-def get_application_structure(
-    project_slug, cc_username, cc_api_key, app_id, request_timeout=None
+def _request_application_structure(
+    project_slug, cc_username, cc_api_key, app_id, request_timeout=None, headers=None
 ):
-    """Retrieve data about a CommCare application's structure from the API
-
-    See: https://confluence.dimagi.com/display/commcarepublic/Application+Structure+API
-
-    Args:
-        project_slug (str): The name of the CommCare project (aka "domain")
-        cc_user_name (str): Valid CommCare username
-        cc_api_key (str): Valid CommCare API key
-        app_id (str): The id of the application
-        request_timeout: Number of seconds for request timeout. This endpoint can take a
-            while so the timeout defaults to a large value of 180.
-
-    Returns:
-        dict: A dict formed from the JSON returned by the response
+    """Make the request to the Application Structure API, raising on failure.
 
+    A `304 Not Modified` response is returned as is so that callers sending
+    conditional request headers can handle it.
     """
     request_timeout = (
         request_timeout if request_timeout else APPLICATION_STRUCTURE_DEFAULT_TIMEOUT
@@ -58,10 +53,11 @@ def get_application_structure(
     url = urljoin(APPLICATION_STRUCTURE_URL.format(project_slug), app_id)
     data = dict(format="json")
     headers = {
+        **(headers if headers else {}),
         "Authorization": f"ApiKey {cc_username}:{cc_api_key}",
     }
     response = requests.get(url, headers=headers, params=data, timeout=request_timeout)
-    if not response.ok:
+    if not response.ok and response.status_code != 304:
         message = (
             f"Something went wrong retrieving app structure for app with id "
             f"`{app_id}`.  The response status code was `{response.status_code}`. "
@@ -73,7 +69,84 @@ def get_application_structure(
         }
         logger.error(message)
         raise CommCareUtilitiesError(message, info)
-    return response.json()
+    return response
+
+
+def get_application_structure(
+    project_slug, cc_username, cc_api_key, app_id, request_timeout=None
+):
+    """Retrieve data about a CommCare application's structure from the API
+
+    See: https://confluence.dimagi.com/display/commcarepublic/Application+Structure+API
+
+    Args:
+        project_slug (str): The name of the CommCare project (aka "domain")
+        cc_user_name (str): Valid CommCare username
+        cc_api_key (str): Valid CommCare API key
+        app_id (str): The id of the application
+        request_timeout: Number of seconds for request timeout. This endpoint can take a
+            while so the timeout defaults to a large value of 180.
+
+    Returns:
+        dict: A dict formed from the JSON returned by the response
+
+    """
+    return _request_application_structure(
+        project_slug, cc_username, cc_api_key, app_id, request_timeout
+    ).json()
+
+
+def get_application_structure_if_modified(
+    project_slug,
+    cc_username,
+    cc_api_key,
+    app_id,
+    request_timeout=None,
+    etag=None,
+    last_modified=None,
+):
+    """Conditionally retrieve a CommCare application's structure from the API
+
+    Sends `If-None-Match` / `If-Modified-Since` headers built from the validators of
+    a previous response, so an unchanged app costs a `304` round trip instead of the
+    full (slow) response.
+
+    Args:
+        project_slug (str): The name of the CommCare project (aka "domain")
+        cc_user_name (str): Valid CommCare username
+        cc_api_key (str): Valid CommCare API key
+        app_id (str): The id of the application
+        request_timeout: Number of seconds for request timeout.
+        etag (str): Optional. The `ETag` header of a previous response
+        last_modified (str): Optional. The `Last-Modified` header of a previous
+            response
+
+    Returns:
+        tuple: The first item is a dict formed from the JSON returned by the response,
+            or None if the server reported the structure as not modified. The second
+            item is a dict with the response's "etag" and "last_modified" validators
+            (either may be None).
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    response = _request_application_structure(
+        project_slug, cc_username, cc_api_key, app_id, request_timeout, headers
+    )
+    if response.status_code == 304:
+        # The structure we have is still current, as are its validators unless the
+        # server sent updated ones
+        return None, {
+            "etag": response.headers.get("ETag", etag),
+            "last_modified": response.headers.get("Last-Modified", last_modified),
+        }
+    # A new structure only ever gets the validators sent with it
+    return response.json(), {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
 
 
 def get_commcare_case(
@@ -94,7 +167,9 @@ def get_commcare_case(
     headers = {
         "Authorization": f"ApiKey {cc_username}:{cc_api_key}",
     }
-    response = requests.get(url, headers=headers, params=data)
+    response = get_commcare_upload_session().get(
+        url, headers=headers, params=data, timeout=request_timeout
+    )
     if not response.ok:
         message = f"Something went wrong retrieving case `{case_id}`"
         info = {
@@ -134,7 +209,9 @@ def get_commcare_cases(
     headers = {
         "Authorization": f"ApiKey {cc_username}:{cc_api_key}",
     }
-    response = requests.get(url, headers=headers, params=data, timeout=request_timeout)
+    response = get_commcare_upload_session().get(
+        url, headers=headers, params=data, timeout=request_timeout
+    )
     if not response.ok:
         message = "Something went wrong downloading data from CommCare"
         info = {
@@ -146,6 +223,33 @@ def get_commcare_cases(
     return response.json()["objects"]
 
 
+def get_commcare_upload_session():
+    """Get this thread's session for CommCare bulk uploads, creating it if needed
+
+    Reusing a session across uploads keeps its connections alive, so each batch
+    doesn't pay for a new TLS handshake. Case lookups made between uploads (see
+    `get_commcare_case` and `get_commcare_cases`) go through the same session for
+    the same reason; only POSTs are retried. Uploads can run on several threads at
+    once and requests sessions aren't thread-safe, so each thread gets its own
+    session. Auth headers are sent per request, since the session is not tied to one
+    user.
+    """
+    session = getattr(_commcare_upload_sessions, "session", None)
+    if session is None:
+        retry_strategy = Retry(
+            total=3,
+            backoff_factor=6,
+            status_forcelist=[429, 500, 503],
+            method_whitelist=["POST"],
+        )
+        adapter = HTTPAdapter(max_retries=retry_strategy)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _commcare_upload_sessions.session = session
+    return session
+
+
 def upload_data_to_commcare(
     df,  # can be dict or pd.DataFrame
     project_slug,
@@ -158,17 +262,10 @@ def upload_data_to_commcare(
     request_timeout=30,
     file_name_prefix="",
 ):
-    retry_strategy = Retry(
-        total=3, backoff_factor=6, status_forcelist=[500], method_whitelist=["POST"]
-    )
     headers = {
         "Authorization": f"ApiKey {cc_username}:{cc_api_key}",
     }
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session = requests.Session()
-    session.headers.update(headers)
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
+    session = get_commcare_upload_session()
     url = BULK_UPLOAD_URL.format(project_slug)
     if not isinstance(df, pd.DataFrame):
         df = pd.DataFrame(df)
@@ -189,7 +286,7 @@ def upload_data_to_commcare(
         search_field=search_field,
         create_new_cases=create_new_cases,
     )
-    req = requests.Request("POST", url, data=body, files=files)
+    req = requests.Request("POST", url, headers=headers, data=body, files=files)
     prepped = session.prepare_request(req)
     response = session.send(prepped, timeout=request_timeout)
 
@@ -209,7 +306,9 @@ def upload_data_to_commcare(
         seconds = 2
         logger.info(f"Sleeping {seconds} seconds and checking upload status...")
         time.sleep(seconds)
-        response_json = session.get(response.json()["status_url"]).json()
+        response_json = session.get(
+            response.json()["status_url"], headers=headers
+        ).json()
 
         if response_json["state"] == COMMCARE_UPLOAD_STATES["failed"]:
             msg = (
@@ -244,25 +343,66 @@ def upload_data_to_commcare(
 
 
 def chunk_list(lst, chunk_size):
-    """Yield successive `chunk_size` chunks from `lst`"""
-    for i in range(0, len(lst), chunk_size):
-        yield lst[i : i + chunk_size]
+    """Yield successive `chunk_size` chunks (as lists) from `lst`, which may be any
+    iterable"""
+    iterator = iter(lst)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
 
 
+@lru_cache(maxsize=None)
 def make_sql_friendly(value, invalid_sql_chars=re.compile(r"[^\w]")):
     """Some CommCare properties and case types include dashes, which make for
     bothersome SQL queries. Remove any non-alphanumeric or underscore
-    characters, then return resulting value."""
+    characters, then return resulting value.
+
+    Results are memoized, as the same property names recur across case types."""
     # Do not substitute "-" with "_" because in at least once instance, that would
     # result in a duplicate property name ("date_opened").
     return invalid_sql_chars.sub("", value)
 
 
+COMMCARE_EXPORT_SYNC_SHEET_HEADERS = [
+    "Data Source",
+    "Filter Name",
+    "Filter Value",
+    "",
+    "Field",
+    "Source Field",
+]
+
+
+def iter_commcare_export_sync_sheet_rows(case_type, source_target_mappings):
+    """Yield the rows of a commcare-export query sheet for a single case type
+
+    The filter goes in columns A-C of the first row after the headers, and the
+    (target, source) mappings go in columns E and F starting on that same row.
+
+    Args:
+        case_type (str): The case type the sheet is for
+        source_target_mappings (list): List of tuples of form
+            ("source_name", "target_name")
+
+    Yields:
+        list: The values of each row, starting with the headers
+    """
+    yield COMMCARE_EXPORT_SYNC_SHEET_HEADERS
+    filter_row = ["case", "type", case_type]
+    sorted_mappings = sorted(source_target_mappings, key=lambda x: x[1])
+    if not sorted_mappings:
+        yield filter_row
+    for idx, (source, target) in enumerate(sorted_mappings):
+        yield (filter_row if idx == 0 else [None] * 3) + [None, target, source]
+
+
 def make_commcare_export_sync_xl_wb(mapping):
     """Create an Excel workbook in format required for commcare-export script
 
     NB: This does not save the workbook, and will need to call wb.save() on object
-    returned by this function in order to persist.
+    returned by this function in order to persist. To just write the workbook to a
+    file, `write_commcare_export_sync_xl_wb` is faster.
 
 
     Args:
@@ -272,14 +412,6 @@ def make_commcare_export_sync_xl_wb(mapping):
     Returns:
         obj: An Openpyxl workbook
     """
-    sheet_headers = [
-        "Data Source",
-        "Filter Name",
-        "Filter Value",
-        "",
-        "Field",
-        "Source Field",
-    ]
     wb = Workbook()
     for idx, (case_type, source_target_mappings) in enumerate(mapping.items()):
         if idx == 0:
@@ -287,19 +419,37 @@ def make_commcare_export_sync_xl_wb(mapping):
         else:
             ws = wb.create_sheet()
         ws.title = case_type
-        ws.append(sheet_headers)
-        ws["A2"] = "case"
-        ws["B2"] = "type"
-        ws["C2"] = case_type
-
-        row_offset = 2
-        for idx, item in enumerate(sorted(source_target_mappings, key=lambda x: x[1])):
-            row_num = idx + row_offset
-            # NOTE: Columns F, E are not in the order they appear in Excel (E, F)
-            ws[f"F{row_num}"], ws[f"E{row_num}"] = item
+        for row in iter_commcare_export_sync_sheet_rows(
+            case_type, source_target_mappings
+        ):
+            ws.append(row)
     return wb
 
 
+def write_commcare_export_sync_xl_wb(mapping, wb_path):
+    """Write an Excel workbook in format required for commcare-export script
+
+    Produces the same sheets as `make_commcare_export_sync_xl_wb`, but streams them
+    straight to `wb_path` with xlsxwriter rather than building an openpyxl workbook
+    in memory first.
+
+    Args:
+        mapping (dict): Dictionary of lists of tuples of form
+            {"case_type": [("source_name", "target_name)]}
+        wb_path (str): Where to save the workbook
+    """
+    wb = xlsxwriter.Workbook(str(wb_path), {"constant_memory": True})
+    try:
+        for case_type, source_target_mappings in mapping.items():
+            ws = wb.add_worksheet(case_type)
+            for row_num, row in enumerate(
+                iter_commcare_export_sync_sheet_rows(case_type, source_target_mappings)
+            ):
+                ws.write_row(row_num, 0, row)
+    finally:
+        wb.close()
+
+
 @retry(
     exceptions=NoCommCareCasesReturned,
     delay=1,
@@ -22,6 +22,7 @@ EMPTY_PHONE_VALUES = ("", None)
 EMPTY_SELECT_VALUES = ("", None)
 TWILIO_INVALID_NUMBER_FOR_REGION_CODE = 404
 TWILIO_LANDLINE_CODE = "landline"
+TWILIO_ACCOUNT_URL = "https://api.twilio.com/2010-04-01/Accounts/{}.json"
 TWILIO_LOOKUP_URL = "https://lookups.twilio.com/v1/PhoneNumbers"
 TWILIO_MOBILE_CODE = "mobile"
 TWILIO_VOIP_CODE = "voip"
@@ -1,4 +1,5 @@
 import csv
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import partial
 from math import ceil
 from urllib.parse import urljoin
@@ -22,6 +23,10 @@ from cc_utilities.constants import (
 from cc_utilities.logger import logger
 
 MAX_CONTACTS_PER_PARENT_PATIENT = 100
+DEFAULT_UPLOAD_MAX_WORKERS = 4
+DATA_DICT_REQUIRED_VALUES = frozenset(
+    {"true", "True", "TRUE", "1", "yes", "Yes", "YES", "y", "Y"}
+)
 
 
 class LegacyUploadError(Exception):
@@ -78,16 +83,17 @@ def validate_case_data_columns(column_names, allowed_columns, required_columns=N
     """Determine if all columns are allowed and all required columns appear
 
      Args:
-        column_names (list): list of column name strings being validated
-        allowed_columns (list): list of allowed column names
-        required_columns (list): list of columns that must appear
+        column_names (iterable): column name strings being validated
+        allowed_columns (iterable): allowed column names; ideally a set
+        required_columns (iterable): columns that must appear
     Returns:
         bool: True if valid, else False
     """
     required_columns = required_columns if required_columns else []
     problems = []
-    unexpected_columns = list(set(column_names).difference(set(allowed_columns)))
-    missing_required_columns = list(set(required_columns).difference(set(column_names)))
+    column_names = set(column_names)
+    unexpected_columns = list(column_names.difference(allowed_columns))
+    missing_required_columns = list(set(required_columns).difference(column_names))
     for col in unexpected_columns:
         problems.append(
             f"Found column `{col}` in case data but this does not appear in data "
@@ -113,7 +119,7 @@ def load_data_dict(data_dict_path):
     Returns:
         dict: A dict whose keys are allowed fields for a case type. For each field,
             there is a dict with the field's group, allowed values, data type,
-            description, and whether or not it is required.
+            description, and whether or not it is required (as a bool).
     """
     with open(data_dict_path) as fl:
         reader = csv.DictReader(fl)
@@ -123,7 +129,7 @@ def load_data_dict(data_dict_path):
                     i.strip() for i in item["allowed_values"].split(",")
                 ],
                 "data_type": item["data_type"],
-                "required": item["required"],
+                "required": item["required"].strip() in DATA_DICT_REQUIRED_VALUES,
             }
             for item in reader
         }
@@ -189,11 +195,65 @@ def generate_cc_dummy_patient_cases(
     return [patient["case_id"] for patient in cc_dummy_patients]
 
 
+def upload_legacy_contact_batch(
+    batch,
+    batch_num,
+    parent_id,
+    project_slug,
+    cc_user_name,
+    cc_api_key,
+    **contact_kwargs,
+):
+    """Upload one batch of legacy contacts under a dummy parent patient
+
+    Args:
+        batch (list): A list of dicts of validated and normalized contact data, each
+            with a `contact_id`
+        batch_num (int): The number of the batch, used for logging
+        parent_id (str): The `case_id` of the dummy patient the contacts belong to
+        project_slug (str): The name of the CommCare project (aka "domain")
+        cc_user_name (str): Valid CommCare username
+        cc_api_key (str): Valid CommCare API key
+        contact_kwargs (dict): Additional key-value pairs to add to each contact.
+    Returns:
+        list: A list of (`contact_id`, `case_id`) tuples for the created contacts
+    """
+    prepped_contacts = [
+        generate_commcare_contact_data(contact, parent_id, **contact_kwargs)
+        for contact in batch
+    ]
+    logger.info(f"Uploading contacts from batch {batch_num} to CommCare")
+    upload_data_to_commcare(
+        prepped_contacts,
+        project_slug,
+        "contact",
+        "case_id",
+        cc_user_name,
+        cc_api_key,
+    )
+    logger.info(
+        f"Retrieving parent case with case_id `{parent_id}` for batch {batch_num}"
+    )
+    parent_case = get_commcare_case(
+        parent_id,
+        project_slug,
+        cc_user_name,
+        cc_api_key,
+        include_child_cases=True,
+    )
+    return [
+        (child_case["properties"]["contact_id"], child_case["case_id"])
+        for child_case in parent_case["child_cases"].values()
+    ]
+
+
 def upload_legacy_contacts_to_commcare(
     valid_normalized_contacts_data,
     project_slug,
     cc_user_name,
     cc_api_key,
+    max_workers=DEFAULT_UPLOAD_MAX_WORKERS,
+    num_contacts=None,
     **contact_kwargs,
 ):
     """Upload a set of legacy contacts to CommCare.
@@ -205,13 +265,21 @@ def upload_legacy_contacts_to_commcare(
     that provides URLs to view uploaded cases in CommCare, alongside the original user-
     supplied data.
 
+    Batches are uploaded concurrently, with up to `max_workers` batches in flight at
+    once, since the time taken is almost entirely spent waiting on CommCare. Contacts
+    are only pulled from `valid_normalized_contacts_data` as batches are submitted, so
+    a generator can be supplied to avoid holding every contact dict in memory.
+
     Args:
-        valid_normalized_contacts_data (list): A list of dicts with user-supplied data
-            for contacts to be uploaded. Additionally, each dict must contain a unique
-            value for a `contact_id` field, which is not user-supplied, and should be
-            dynamically generated in the calling context.
+        valid_normalized_contacts_data (iterable): An iterable of dicts with user-
+            supplied data for contacts to be uploaded. Additionally, each dict must
+            contain a unique value for a `contact_id` field, which is not user-
+            supplied, and should be dynamically generated in the calling context.
         project_slug (str): The name of the CommCare project (aka "domain")
         cc_user_name (str): Valid CommCare username
+        max_workers (int): Optional. The maximum number of batches to upload at once.
+        num_contacts (int): Optional. The number of contacts to be uploaded. Required
+            if `valid_normalized_contacts_data` does not support `len()`.
         contact_kwargs (dict): Additional key-value pairs to add to each contact.
             This is to support per-CommCare install specific requirements around
             fields that should be included on uploaded legacy-contacts.
@@ -219,79 +287,66 @@ def upload_legacy_contacts_to_commcare(
         dict: A dict whose keys are 'contact_ids' and whose values are 'case_ids' of
             created contacts
     """
-    num_dummy_patients = ceil(
-        len(valid_normalized_contacts_data) / MAX_CONTACTS_PER_PARENT_PATIENT
-    )
-    logger.info(f"Generating {num_dummy_patients} dummy patients")
+    if num_contacts is None:
+        num_contacts = len(valid_normalized_contacts_data)
+    expected_batches = ceil(num_contacts / MAX_CONTACTS_PER_PARENT_PATIENT)
+    logger.info(f"Generating {expected_batches} dummy patients")
     patients = generate_cc_dummy_patient_cases(
-        project_slug, cc_user_name, cc_api_key, num_dummies=num_dummy_patients
-    )
-    expected_batches = ceil(
-        len(valid_normalized_contacts_data) / MAX_CONTACTS_PER_PARENT_PATIENT
+        project_slug, cc_user_name, cc_api_key, num_dummies=expected_batches
     )
     logger.info(
         f"Processing contacts in {expected_batches} "
         f"{'batch' if expected_batches == 1 else 'batches'} of "
-        f"{MAX_CONTACTS_PER_PARENT_PATIENT} contacts per batch."
+        f"{MAX_CONTACTS_PER_PARENT_PATIENT} contacts per batch, uploading up to "
+        f"{max_workers} at a time."
     )
 
-    created_contacts = []
+    result = {}
 
-    for i, batch in enumerate(
-        chunk_list(valid_normalized_contacts_data, MAX_CONTACTS_PER_PARENT_PATIENT)
-    ):
-        batch_num = i + 1
-        logger.info(
-            f"Processing batch {batch_num} of {expected_batches} consisting of "
-            f"{len(batch)} contacts."
-        )
-        parent_id = patients.pop()
-        prepped_contacts = [
-            generate_commcare_contact_data(contact, parent_id, **contact_kwargs)
-            for contact in batch
-        ]
-        try:
-            logger.info(f"Uploading contacts from batch {batch_num} to CommCare")
-            upload_data_to_commcare(
-                prepped_contacts,
-                project_slug,
-                "contact",
-                "case_id",
-                cc_user_name,
-                cc_api_key,
-            )
+    def _collect(done_futures):
+        for future in done_futures:
+            batch_num = pending.pop(future)
+            try:
+                result.update(future.result())
+            # This is a rare exception (hah!) where a catch all except block is a good
+            # idea. If there are multiple batches to be processed, and some succeed,
+            # but others fail, we want to return a result to the calling context so a
+            # report can be generated indicating which contacts were succesfully
+            # uploaded. This will make it possible to remove rows that were succesfully
+            # uploaded from the originally supplied data and try again later, without
+            # generating duplicate case data in CommCare.
+            except Exception:
+                logger.exception(
+                    f"[upload_legacy_contacts_to_commcare] Something went wrong with "
+                    f"batch {batch_num}"
+                )
+
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i, batch in enumerate(
+            chunk_list(valid_normalized_contacts_data, MAX_CONTACTS_PER_PARENT_PATIENT)
+        ):
+            # don't read ahead of the workers, so only `max_workers` batches are
+            # held in memory at a time
+            if len(pending) >= max_workers:
+                _collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            batch_num = i + 1
             logger.info(
-                f"Retrieving parent case with case_id `{parent_id}` "
-                f"for batch {batch_num}"
+                f"Processing batch {batch_num} of {expected_batches} consisting of "
+                f"{len(batch)} contacts."
             )
-            parent_case = get_commcare_case(
-                parent_id,
+            future = executor.submit(
+                upload_legacy_contact_batch,
+                batch,
+                batch_num,
+                patients.pop(),
                 project_slug,
                 cc_user_name,
                 cc_api_key,
-                include_child_cases=True,
+                **contact_kwargs,
             )
-            for k in parent_case["child_cases"]:
-                created_contacts.append(
-                    (
-                        parent_case["child_cases"][k]["properties"]["contact_id"],
-                        parent_case["child_cases"][k]["case_id"],
-                    )
-                )
-        # This is a rare exception (hah!) where a catch all except block is a good idea.
-        # If there are multiple batches to be processed, and early ones succeed, but
-        # a later one fails, we want to return a result to the calling context so a
-        # report can be generated indicating which contacts were succesfully uploaded.
-        # This will make it possible to remove rows that were succesfully uploaded from
-        # the originally supplied data and try again later, without generating duplicate
-        # case data in CommCare.
-        except Exception:
-            logger.exception(
-                "[upload_legacy_contacts_to_commcare] Something went wrong"
-            )
-    result = {}
-    for item in created_contacts:
-        result[item[0]] = item[1]
+            pending[future] = batch_num
+        _collect(list(pending))
     return result
 
 
@@ -649,6 +704,32 @@ def get_normalization_fn(col_name, data_dict):
         return lambda val: " ".join([item.strip() for item in val.split(",")])
 
 
+def get_column_normalization_fn(col_name, data_dict):
+    """Look up a function that normalizes a whole column based on data dictionary
+
+    String clean-up is done with vectorized `.str` methods. Other types fall back to
+    the per-value function from `get_normalization_fn`, called once per distinct value
+    since dates and phone numbers tend to repeat and are slow to parse.
+
+    Args:
+        col_name (str): The name of a column
+        data_dict (dict): A dictionary whose keys are `col_name`s and whose values
+            are a dict.
+
+    Returns:
+        function: A function that takes a column (Series) and returns it normalized.
+    """
+    col_type = data_dict[col_name]["data_type"]
+    if col_type in ("plain", "select"):
+        return lambda col: col.str.strip()
+    if col_type == "multi_select":
+        # Same as stripping each comma-separated item and joining them with spaces:
+        # empty items (e.g., from a trailing comma) are kept as empty strings
+        return lambda col: col.str.strip().str.replace(r"\s*,\s*", " ", regex=True)
+    normalize = get_normalization_fn(col_name, data_dict)
+    return lambda col: col.map({val: normalize(val) for val in col.unique()})
+
+
 def normalize_legacy_case_data(validated_df, data_dict, ignore_columns=None):
     """Normalize (validated) legacy case data based on a data dictionary
 
@@ -665,8 +746,8 @@ def normalize_legacy_case_data(validated_df, data_dict, ignore_columns=None):
     validated_df = validated_df.copy(deep=True)
     ignore_columns = ignore_columns if ignore_columns else []
     for col in validated_df.columns.drop(ignore_columns):
-        validated_df[col] = validated_df[col].apply(
-            get_normalization_fn(col, data_dict)
+        validated_df[col] = get_column_normalization_fn(col, data_dict)(
+            validated_df[col]
         )
     return validated_df
 
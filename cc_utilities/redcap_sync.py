@@ -1,12 +1,15 @@
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from functools import partial
+from functools import lru_cache, partial
 
+import numpy as np
 import pandas as pd
 import redcap
-from sqlalchemy import MetaData, Table, create_engine, select
+from sqlalchemy import column, create_engine, select, table
 
-from .common import CommCareUtilitiesError, upload_data_to_commcare
+from .common import CommCareUtilitiesError, chunk_list, upload_data_to_commcare
 from .constants import (
     ACCEPTED_INTERVIEW_DISPOSITION_VALUES,
     DOB_FIELD,
@@ -30,6 +33,107 @@ from .constants import (
 from .legacy_upload import normalize_phone_number
 from .logger import logger
 
+# Number of REDCap records to request per export call, and how many of those calls
+# to make at a time. See export_records_chunked().
+DEFAULT_REDCAP_EXPORT_CHUNK_SIZE = 500
+DEFAULT_REDCAP_EXPORT_MAX_WORKERS = 4
+# How many incomplete records to upload to CommCare at a time. See
+# upload_incomplete_records().
+DEFAULT_INCOMPLETE_UPLOAD_MAX_WORKERS = 4
+REDCAP_EXPORT_DF_KWARGS = {
+    # Without index_col=False, read_csv() will use the first column
+    # ("record_id") as the index, which is problematic because it's
+    # not unique and is easier to handle as a separate column anyways.
+    "index_col": False,
+    # We import everything as a string, to avoid pandas coercing ints
+    # to floats and adding unnecessary decimal points in the data when
+    # uploaded to CommCare.
+    "dtype": str,
+}
+
+
+@lru_cache(maxsize=None)
+def get_redcap_project(redcap_api_url, redcap_api_key):
+    """
+    Get a `redcap.Project` for the given API URL and key, reusing it if one has
+    already been created in this process.
+
+    Creating a `redcap.Project` makes several API calls to fetch the project's
+    metadata, so a sync should only pay for that once rather than every time it
+    talks to REDCap.
+    """
+    return redcap.Project(redcap_api_url, redcap_api_key)
+
+
+def export_records_chunked(
+    redcap_api_url,
+    redcap_api_key,
+    chunk_size=DEFAULT_REDCAP_EXPORT_CHUNK_SIZE,
+    max_workers=DEFAULT_REDCAP_EXPORT_MAX_WORKERS,
+    **export_kwargs,
+):
+    """
+    Export records from REDCap as a DataFrame, a chunk of records at a time.
+
+    Only the record IDs matching `export_kwargs` (e.g., `date_begin` and
+    `filter_logic`) are exported up front. The full records are then exported
+    `chunk_size` IDs at a time, with up to `max_workers` requests in flight, and
+    concatenated in order. This keeps any single REDCap request small and overlaps
+    the network time of the chunks.
+
+    A `redcap.Project` makes its requests through a `requests` session, which isn't
+    thread-safe, so each worker thread exports with a `redcap.Project` of its own.
+
+    Args:
+        redcap_api_url (str): The URL to the REDCap API server
+        redcap_api_key (str): The REDCap API key
+        chunk_size (int): The number of record IDs to export per request
+        max_workers (int): The maximum number of export requests to make at a time
+        export_kwargs: Passed to every `export_records` call
+
+    Returns:
+        object: A pandas DataFrame of all matching records, with string values
+    """
+    redcap_project = get_redcap_project(redcap_api_url, redcap_api_key)
+    record_ids_df = redcap_project.export_records(
+        fields=[REDCAP_RECORD_ID],
+        format="df",
+        df_kwargs=REDCAP_EXPORT_DF_KWARGS,
+        **export_kwargs,
+    )
+    # record_id is not unique (e.g., with repeating instruments)
+    record_ids = record_ids_df[REDCAP_RECORD_ID].drop_duplicates().tolist()
+    if not record_ids:
+        return record_ids_df
+
+    def _export_chunk(project, chunk):
+        return project.export_records(
+            records=chunk,
+            format="df",
+            df_kwargs=REDCAP_EXPORT_DF_KWARGS,
+            **export_kwargs,
+        )
+
+    worker_projects = threading.local()
+
+    def _export_chunk_in_worker(chunk):
+        project = getattr(worker_projects, "project", None)
+        if project is None:
+            project = redcap.Project(redcap_api_url, redcap_api_key)
+            worker_projects.project = project
+        return _export_chunk(project, chunk)
+
+    chunks = list(chunk_list(record_ids, chunk_size))
+    logger.info(
+        f"Exporting {len(record_ids)} REDCap records in chunks of {chunk_size}."
+    )
+    if len(chunks) == 1 or max_workers == 1:
+        frames = [_export_chunk(redcap_project, chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            frames = list(executor.map(_export_chunk_in_worker, chunks))
+    return pd.concat(frames, ignore_index=True)
+
 
 def get_cc_properties_and_source_val_lists(df):
     """
@@ -44,30 +148,22 @@ def get_cc_properties_and_source_val_lists(df):
     return cc_properties.items()
 
 
-def get_checkbox_values(row, source_val_list):
+def get_checkbox_values(df, source_val_list):
     """
-    For the given DataFrame row and source_val_list (tuples of (redcap_col, cc_value)),
+    For the given DataFrame and source_val_list (tuples of (redcap_col, cc_value)),
     collect the string representations of the checkbox values for CommCare and
-    return the space-delimited list. Intended to be used via DataFrame.apply().
-    """
-    return (
-        " ".join(
-            # If REDCap value is equal to "1", return cc_value,
-            # else return False (to be filtered out by filter()).
-            filter(
-                bool,
-                [
-                    cc_value
-                    if pd.notnull(row[redcap_col]) and row[redcap_col].strip() == "1"
-                    else False
-                    for redcap_col, cc_value in source_val_list
-                ],
-            )
-        )
-        # If "", return None instead so empty columns can be filtered out properly
-        # by split_cases_and_contacts().
-        or None
-    )
+    return a Series of the space-delimited lists, built a column at a time.
+    """
+    selected = pd.Series("", index=df.index, dtype=object)
+    for redcap_col, cc_value in source_val_list:
+        # A REDCap value of "1" means the box was checked
+        is_checked = df[redcap_col].fillna("").str.strip() == "1"
+        selected[is_checked] += f"{cc_value} "
+    selected = selected.str.rstrip()
+    # If "", return None instead so empty columns can be filtered out properly
+    # by split_cases_and_contacts().
+    selected[selected == ""] = None
+    return selected
 
 
 def collapse_checkbox_columns(df):
@@ -79,11 +175,7 @@ def collapse_checkbox_columns(df):
     for cc_property, source_val_list in get_cc_properties_and_source_val_lists(df):
         # Add new column with the checkbox values collapsed into a single column
         logger.info(f"Adding column {cc_property} to df")
-        df[cc_property] = df.apply(
-            get_checkbox_values,
-            args=(source_val_list,),
-            axis=1,
-        )
+        df[cc_property] = get_checkbox_values(df, source_val_list)
         # Remove the obsolete columns
         redcap_cols = [col for col, _ in source_val_list]
         logger.info(f"Dropping columns {redcap_cols} from df")
@@ -98,14 +190,9 @@ def collapse_housing_fields(df):
     If the value of housing_1 is 'other', then select the value of 'housing_2'.
     """
     df = df.copy()
-
-    def apply_collapse_housing(row):
-        housing = row[REDCAP_HOUSING_1_FIELD]
-        if row[REDCAP_HOUSING_1_FIELD] == REDCAP_HOUSING_OTHER:
-            housing = row[REDCAP_HOUSING_2_FIELD]
-        return housing
-
-    df[REDCAP_HOUSING_FIELD] = df.apply(lambda row: apply_collapse_housing(row), axis=1)
+    df[REDCAP_HOUSING_FIELD] = df[REDCAP_HOUSING_1_FIELD].where(
+        df[REDCAP_HOUSING_1_FIELD] != REDCAP_HOUSING_OTHER, df[REDCAP_HOUSING_2_FIELD]
+    )
     df = df.drop([REDCAP_HOUSING_1_FIELD, REDCAP_HOUSING_2_FIELD], axis=1)
     return df
 
@@ -210,14 +297,7 @@ def populate_symptom_columns(df):
     df[SYMPTOM_COUNT] = df[symptom_columns].astype(int).sum(axis=1)
 
     logger.info(f"Calculating and adding column {SYMPTOMATIC} to df.")
-
-    def apply_symptomatic(row):
-        if row[SYMPTOM_COUNT] > 0:
-            return "yes"
-        else:
-            return "no"
-
-    df[SYMPTOMATIC] = df.apply(lambda row: apply_symptomatic(row), axis=1)
+    df[SYMPTOMATIC] = np.where(df[SYMPTOM_COUNT] > 0, "yes", "no")
     return df
 
 
@@ -232,6 +312,16 @@ def set_external_id_column(df, external_id_col):
     return df
 
 
+@lru_cache(maxsize=None)
+def get_sql_mirror_engine(db_url):
+    """
+    Get a SQLAlchemy engine for the SQL Mirror at `db_url`, reusing it if one has
+    already been created in this process, so that its connection pool is shared by
+    every lookup in a sync.
+    """
+    return create_engine(db_url)
+
+
 def query_sql_mirror_by_external_ids_for_col(
     df, db_url, external_id_col, table_name, column_name
 ):
@@ -242,17 +332,21 @@ def query_sql_mirror_by_external_ids_for_col(
     another record's data.
 
     Returns a list of matching rows, as dictionaries with external_id_col values.
+
+    The query names only the columns it needs rather than reflecting the (often
+    very wide) case table, and sends each external ID once in a single `IN` clause.
     """
-    external_ids = df[EXTERNAL_ID].tolist()
-    engine = create_engine(db_url)
-    meta = MetaData(bind=engine)
-    table = Table(table_name, meta, autoload=True, autoload_with=engine)
+    external_ids = df[EXTERNAL_ID].dropna().unique().tolist()
+    engine = get_sql_mirror_engine(db_url)
+    sql_table = table(
+        table_name, column(external_id_col), column(column_name), column(DOB_FIELD)
+    )
     query = select(
-        [getattr(table.c, external_id_col), getattr(table.c, column_name)]
+        [getattr(sql_table.c, external_id_col), getattr(sql_table.c, column_name)]
     ).where(
-        getattr(table.c, external_id_col).in_(external_ids),
-        getattr(table.c, DOB_FIELD).isnot(None),
-        getattr(table.c, DOB_FIELD) != "",
+        getattr(sql_table.c, external_id_col).in_(external_ids),
+        getattr(sql_table.c, DOB_FIELD).isnot(None),
+        getattr(sql_table.c, DOB_FIELD) != "",
     )
     return pd.read_sql(query, engine).to_dict(orient="records")
 
@@ -337,7 +431,7 @@ def import_records_to_redcap(df, redcap_api_url, redcap_api_key):
     This is used to update records in REDCap with the integration status.
     """
     logger.info(f"Updating {len(df.index)} records in REDCap.")
-    redcap_project = redcap.Project(redcap_api_url, redcap_api_key)
+    redcap_project = get_redcap_project(redcap_api_url, redcap_api_key)
     response = redcap_project.import_records(
         to_import=df,
         overwrite="normal",  # Default, ignores blank values.
@@ -510,7 +604,11 @@ def upload_complete_records(
 
 
 def upload_incomplete_records(
-    incomplete_records, commcare_api_key, commcare_project_name, commcare_user_name
+    incomplete_records,
+    commcare_api_key,
+    commcare_project_name,
+    commcare_user_name,
+    max_workers=DEFAULT_INCOMPLETE_UPLOAD_MAX_WORKERS,
 ):
     """
     To avoid overwriting existing data in CommCare with blank values,
@@ -518,29 +616,43 @@ def upload_incomplete_records(
     before uploading to CommCare.
     **Note that iterating over rows of a DataFrame is slow and not recommended for
     most use cases!
+
+    Each upload waits on CommCare to process it, so up to `max_workers` uploads are
+    made at a time. Rows sharing an external ID are uploaded one after the other, in
+    order, so a later row still wins over an earlier one.
     """
     logger.info(
         f"Uploading {len(incomplete_records.index)} found patients (cases) "
         f"with incomplete records to CommCare..."
     )
+    rows_by_external_id = defaultdict(list)
     for index, row in incomplete_records.iterrows():
-        # Drops any values in this Series with missing/NA values,
-        # and converts it back to a DataFrame.
-        # **Note that iterrows does not preserve the type of a cell.
-        data = row.dropna().to_frame().transpose()
-        try:
-            upload_data_to_commcare(
-                data,
-                commcare_project_name,
-                "patient",
-                EXTERNAL_ID,
-                commcare_user_name,
-                commcare_api_key,
-                create_new_cases="off",
-                search_field=EXTERNAL_ID,
-                file_name_prefix="redcap_incomplete_",
-            )
-        except CommCareUtilitiesError:
-            logger.exception(
-                f"Failed to sync data for external ID {data[EXTERNAL_ID]}; ignoring."
-            )
+        rows_by_external_id[row[EXTERNAL_ID]].append(row)
+
+    def _upload_rows(rows):
+        for row in rows:
+            # Drops any values in this Series with missing/NA values,
+            # and converts it back to a DataFrame.
+            # **Note that iterrows does not preserve the type of a cell.
+            data = row.dropna().to_frame().transpose()
+            try:
+                upload_data_to_commcare(
+                    data,
+                    commcare_project_name,
+                    "patient",
+                    EXTERNAL_ID,
+                    commcare_user_name,
+                    commcare_api_key,
+                    create_new_cases="off",
+                    search_field=EXTERNAL_ID,
+                    file_name_prefix="redcap_incomplete_",
+                )
+            except CommCareUtilitiesError:
+                logger.exception(
+                    f"Failed to sync data for external ID {data[EXTERNAL_ID]}; "
+                    "ignoring."
+                )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the results so any unexpected error is raised here
+        list(executor.map(_upload_rows, rows_by_external_id.values()))
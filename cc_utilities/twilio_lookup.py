@@ -1,5 +1,8 @@
 import copy
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import phonenumbers
@@ -17,6 +20,7 @@ from .constants import (
     COMMCARE_CANNOT_SMS_LABEL,
     COMMCARE_PHONE_FIELD,
     COMMCARE_UNSET_CAN_SMS_LABEL,
+    TWILIO_ACCOUNT_URL,
     TWILIO_LOOKUP_URL,
     TWILIO_MOBILE_CODE,
     WHITE_LISTED_TWILIO_CODES,
@@ -28,6 +32,17 @@ from .logger import logger
 TWILIO_LOOKUP_STATE_DB_FILE = "twilio_lookup_state.db"
 # Table name for bad CommCare IDs in the Twilio lookup state DB.
 BAD_PCC_IDS_TABLE_NAME = "bad_commcare_ids"
+# How many Twilio lookups to make at a time
+DEFAULT_LOOKUP_MAX_WORKERS = 8
+# Cap on Twilio lookups per second, to stay under the account's rate limit rather
+# than burning time on 429 retries
+DEFAULT_LOOKUP_REQUESTS_PER_SECOND = 50
+# Per-thread requests sessions for Twilio lookups. See get_twilio_session().
+_twilio_sessions = threading.local()
+# Every session handed out by get_twilio_session(), so they can be closed together.
+# See close_twilio_sessions().
+_all_twilio_sessions = []
+_all_twilio_sessions_lock = threading.Lock()
 
 
 class TwilioLookUpError(Exception):
@@ -36,8 +51,43 @@ class TwilioLookUpError(Exception):
         self.info = info
 
 
-def process_records(data, search_column, twilio_sid, twilio_token):
-    """Process a set of records' phone numbers to determine if can have SMS sent"""
+class RateLimiter:
+    """Space out calls from any number of threads to at most `per_second` a second"""
+
+    def __init__(self, per_second):
+        self.interval = 1 / per_second
+        self.lock = threading.Lock()
+        self.next_call = time.monotonic()
+
+    def wait(self):
+        """Block until the caller is allowed to make its next call"""
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(self.next_call, now)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+def process_records(
+    data,
+    search_column,
+    twilio_sid,
+    twilio_token,
+    max_workers=DEFAULT_LOOKUP_MAX_WORKERS,
+    requests_per_second=DEFAULT_LOOKUP_REQUESTS_PER_SECOND,
+    executor=None,
+):
+    """Process a set of records' phone numbers to determine if can have SMS sent
+
+    Twilio lookups are network-bound, so up to `max_workers` are made at a time, but
+    no more than `requests_per_second` are started each second.
+
+    When processing many batches, pass in one long-lived `executor` to run the
+    lookups on (`max_workers` is then ignored). Its threads, and so their Twilio
+    sessions and keep-alive connections, are reused from batch to batch. Otherwise
+    a thread pool is created for this call only.
+    """
 
     records = [
         dict(
@@ -61,13 +111,26 @@ def process_records(data, search_column, twilio_sid, twilio_token):
                 f"unable to receive sms."
             )
             record[COMMCARE_CAN_RECEIVE_SMS_FIELD_NAME] = COMMCARE_CANNOT_SMS_LABEL
-    for record in records:
-        if record["standard_formatted_number"] is not None:
-            record[COMMCARE_CAN_RECEIVE_SMS_FIELD_NAME] = process_phone_number(
-                record[COMMCARE_PHONE_FIELD],
-                twilio_sid,
-                twilio_token,
-            )
+    lookup_records = [
+        record for record in records if record["standard_formatted_number"] is not None
+    ]
+    rate_limiter = RateLimiter(requests_per_second)
+
+    def _lookup(record):
+        rate_limiter.wait()
+        return process_phone_number(
+            record[COMMCARE_PHONE_FIELD],
+            twilio_sid,
+            twilio_token,
+        )
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            sms_capabilities = list(executor.map(_lookup, lookup_records))
+    else:
+        sms_capabilities = executor.map(_lookup, lookup_records)
+    for record, sms_capability in zip(lookup_records, sms_capabilities):
+        record[COMMCARE_CAN_RECEIVE_SMS_FIELD_NAME] = sms_capability
 
     return records
 
@@ -94,27 +157,79 @@ def format_phone_number(raw, region="US"):
     return f"+{parsed.country_code}{parsed.national_number}"
 
 
+def get_twilio_session():
+    """
+    Get this thread's Twilio session, creating it (with a retry strategy) if needed.
+
+    Lookups run on a thread pool, and requests sessions aren't thread-safe, so each
+    thread keeps its own session. That lets a thread's lookups reuse one keep-alive
+    connection instead of opening a new one per number.
+    """
+    session = getattr(_twilio_sessions, "session", None)
+    if session is None:
+        retry_strategy = Retry(
+            total=5,
+            backoff_factor=6,
+            # 429 = "Too Many Requests"
+            # https://support.twilio.com/hc/en-us/articles/360044308153-Twilio-API-response-Error-429-Too-Many-Requests-
+            status_forcelist=[429],
+        )
+        adapter = HTTPAdapter(max_retries=retry_strategy)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _twilio_sessions.session = session
+        with _all_twilio_sessions_lock:
+            _all_twilio_sessions.append(session)
+    return session
+
+
+def close_twilio_sessions():
+    """
+    Close every session created by `get_twilio_session()`, releasing their pooled
+    connections. Call this once the threads making lookups are done with them.
+    """
+    with _all_twilio_sessions_lock:
+        sessions = _all_twilio_sessions[:]
+        _all_twilio_sessions.clear()
+    # Other threads' sessions go with their thread-locals once the threads exit
+    _twilio_sessions.session = None
+    for session in sessions:
+        session.close()
+
+
 def twilio_http_request(method, url, sid, auth_token):
     """
     Issue an HTTP request to Twilio with a retry strategy.
     """
-    retry_strategy = Retry(
-        total=5,
-        backoff_factor=6,
-        # 429 = "Too Many Requests"
-        # https://support.twilio.com/hc/en-us/articles/360044308153-Twilio-API-response-Error-429-Too-Many-Requests-
-        status_forcelist=[429],
+    return get_twilio_session().request(
+        method,
+        url,
+        auth=(sid, auth_token),
+        params={"Type": "carrier"},
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    with requests.Session() as session:
-        session.mount("https://", adapter)
-        session.mount("http://", adapter)
-        return session.request(
-            method,
-            url,
-            auth=(sid, auth_token),
-            params={"Type": "carrier"},
+
+
+def check_twilio_credentials(sid, auth_token):
+    """Make sure a Twilio SID and auth token are valid, without doing a lookup
+
+    Fetching the account resource is free, so this is a cheap way to find out about
+    bad credentials before any lookups are made.
+
+    Args:
+        sid (str): A Twilio SID
+        auth_token (str): A Twilio auth token
+    """
+    response = get_twilio_session().get(
+        TWILIO_ACCOUNT_URL.format(sid), auth=(sid, auth_token)
+    )
+    if not response.ok:
+        message = (
+            f"Could not authenticate with Twilio. The response status code was "
+            f"`{response.status_code}`."
         )
+        info = {"twilio_status_code": response.status_code}
+        raise TwilioLookUpError(message, info)
 
 
 def twilio_lookup_phone_number_type(formatted_number, sid, auth_token):
@@ -173,18 +288,19 @@ def process_phone_number(formatted_number, sid, auth_token):
     )
 
 
-def get_unprocessed_phone_numbers(db_url, table_name="contact", search_column="id"):
-    """Get a list of contact phone numbers that haven't been verified for SMS
+def build_unprocessed_phone_numbers_query(
+    engine, table_name="contact", search_column="id"
+):
+    """Build a query for contact phone numbers that haven't been verified for SMS
 
     Args:
-        db_url (str): the db connection URL
+        engine (object): A SQLAlchemy engine for the db
+        table_name (str): the name of the table to query
         search_column (str): the name of the unique id column in the db for contact
 
     Returns:
-        list: List of dicts with key/values for the search column and
-            `contact_phone_number`
+        object: A SQLAlchemy select for the search column and `contact_phone_number`
     """
-    engine = create_engine(db_url)
     meta = MetaData(bind=engine)
     table = Table(table_name, meta, autoload=True, autoload_with=engine)
     assert COMMCARE_PHONE_FIELD in [
@@ -211,17 +327,75 @@ def get_unprocessed_phone_numbers(db_url, table_name="contact", search_column="i
                 == COMMCARE_UNSET_CAN_SMS_LABEL,
             )
         )
-    query = select(
+    return select(
         [getattr(table.c, search_column), getattr(table.c, COMMCARE_PHONE_FIELD)]
     ).where(and_(*wheres))
+
+
+def count_unprocessed_phone_numbers(db_url, table_name="contact", search_column="id"):
+    """Count contact phone numbers that haven't been verified for SMS
+
+    Args:
+        db_url (str): the db connection URL
+        table_name (str): the name of the table to query
+        search_column (str): the name of the unique id column in the db for contact
+
+    Returns:
+        int: The number of unprocessed phone numbers
+    """
+    engine = create_engine(db_url)
+    query = build_unprocessed_phone_numbers_query(engine, table_name, search_column)
+    conn = engine.connect()
+    try:
+        return conn.execute(select([func.count()]).select_from(query.alias())).scalar()
+    finally:
+        conn.close()
+
+
+def iter_unprocessed_phone_numbers(
+    db_url, table_name="contact", search_column="id", fetch_size=1000
+):
+    """Lazily yield contact phone numbers that haven't been verified for SMS
+
+    Rows are streamed from the db `fetch_size` at a time rather than loaded all at
+    once.
+
+    Args:
+        db_url (str): the db connection URL
+        table_name (str): the name of the table to query
+        search_column (str): the name of the unique id column in the db for contact
+        fetch_size (int): How many rows to fetch from the db at a time
+
+    Returns:
+        iterator: Dicts with key/values for the search column and
+            `contact_phone_number`
+    """
+    engine = create_engine(db_url)
+    query = build_unprocessed_phone_numbers_query(engine, table_name, search_column)
     conn = engine.connect()
     try:
-        result = conn.execute(query)
-        return [dict(row) for row in result.fetchall()]
+        result = conn.execution_options(stream_results=True).execute(query)
+        for rows in iter(lambda: result.fetchmany(fetch_size), []):
+            for row in rows:
+                yield dict(row)
     finally:
         conn.close()
 
 
+def get_unprocessed_phone_numbers(db_url, table_name="contact", search_column="id"):
+    """Get a list of contact phone numbers that haven't been verified for SMS
+
+    Args:
+        db_url (str): the db connection URL
+        search_column (str): the name of the unique id column in the db for contact
+
+    Returns:
+        list: List of dicts with key/values for the search column and
+            `contact_phone_number`
+    """
+    return list(iter_unprocessed_phone_numbers(db_url, table_name, search_column))
+
+
 def get_sqlite_conn():
     """
     Obtains a connection to a local state file in the form of a sqlite3 database
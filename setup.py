@@ -23,6 +23,7 @@ setup(
         "pycap~=1.1.2",  # REDCap API
         "numpy==1.19.3",  # windows env chokes on > than this version
         "xlrd",
+        "XlsxWriter",
     ],
     entry_points={
         "console_scripts": [
@@ -1,4 +1,11 @@
-from cc_utilities.common import make_commcare_export_sync_xl_wb
+import requests
+from openpyxl import load_workbook
+
+from cc_utilities.common import (
+    get_application_structure_if_modified,
+    make_commcare_export_sync_xl_wb,
+    write_commcare_export_sync_xl_wb,
+)
 
 
 def test_make_commcare_export_xl_wb():
@@ -33,3 +40,56 @@ def test_make_commcare_export_xl_wb():
                 map(lambda cell: cell.value, sheet["E"][1:]),
             )
         )
+
+
+def test_get_application_structure_if_modified(monkeypatch):
+    "Show that validators are sent and a 304 yields no structure"
+    calls = []
+
+    def fake_get(url, headers=None, **kwargs):
+        calls.append(headers)
+        response = requests.models.Response()
+        if headers.get("If-None-Match") == '"v1"':
+            response.status_code = 304
+        else:
+            response.status_code = 200
+            if headers.get("If-None-Match") != '"v0"':
+                response.headers["ETag"] = '"v1"'
+            response._content = b'{"modules": []}'
+        return response
+
+    monkeypatch.setattr("cc_utilities.common.requests.get", fake_get)
+    structure, validators = get_application_structure_if_modified(
+        "project", "user", "key", "app-id"
+    )
+    assert structure == {"modules": []}
+    assert validators == {"etag": '"v1"', "last_modified": None}
+    structure, validators = get_application_structure_if_modified(
+        "project", "user", "key", "app-id", etag=validators["etag"]
+    )
+    assert structure is None
+    assert validators["etag"] == '"v1"'
+    assert "If-None-Match" not in calls[0]
+    # a changed structure without validators doesn't keep the old ones
+    structure, validators = get_application_structure_if_modified(
+        "project", "user", "key", "app-id", etag='"v0"', last_modified="yesterday"
+    )
+    assert structure == {"modules": []}
+    assert validators == {"etag": None, "last_modified": None}
+
+
+def test_write_commcare_export_sync_xl_wb(tmp_path):
+    "Show that `write_commcare_export_sync_xl_wb` matches the openpyxl workbook"
+    mappings = {
+        "contact": [("properties.first_name", "first_name"), ("case_id", "case_id")],
+        "empty": [],
+    }
+    wb_path = tmp_path / "mapping.xlsx"
+    write_commcare_export_sync_xl_wb(mappings, wb_path)
+    written = load_workbook(wb_path)
+    expected = make_commcare_export_sync_xl_wb(mappings)
+    assert written.sheetnames == expected.sheetnames
+    for sheet in expected:
+        assert [
+            [cell.value or None for cell in row] for row in written[sheet.title].rows
+        ] == [[cell.value or None for cell in row] for row in sheet.rows]
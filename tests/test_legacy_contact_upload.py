@@ -1,5 +1,6 @@
 import csv
 import glob
+import io
 import random
 import tempfile
 from pathlib import PurePath
@@ -8,17 +9,22 @@ from uuid import uuid4
 import pandas as pd
 import pytest
 from faker import Faker
+from openpyxl import Workbook, load_workbook
 
 from cc_utilities.command_line.bulk_upload_legacy_contact_data import (
     FINAL_REPORT_FILE_NAME_PART,
     VALIDATION_REPORT_FILE_NAME_PART,
-    convert_xl_wb_to_csv_string_io,
+    WB_CONTACT_SHEET_NAME,
+    load_xl_wb_sheet_as_df,
     main_with_args,
+    write_df_to_xl_wb,
 )
 from cc_utilities.legacy_upload import (
     MAX_CONTACTS_PER_PARENT_PATIENT,
     create_dummy_patient_case_data,
     generate_commcare_contact_data,
+    load_data_dict,
+    normalize_legacy_case_data,
     upload_legacy_contacts_to_commcare,
     validate_case_data_columns,
     validate_legacy_case_data,
@@ -28,6 +34,26 @@ Faker.seed(0)
 fake = Faker("en_US")
 
 
+def convert_xl_wb_to_csv_string_io(wb_path, sheet_name=WB_CONTACT_SHEET_NAME):
+    """Convert a sheet of an Excel workbook into a string IO of CSV data
+
+    Empty rows are skipped. Used to read generated reports, and as the reference
+    behavior that `load_xl_wb_sheet_as_df` must match.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    wb = load_workbook(wb_path, read_only=True, data_only=True)
+    try:
+        for row in wb[sheet_name].rows:
+            values = [cell.value for cell in row]
+            if any(values):
+                writer.writerow(values)
+    finally:
+        wb.close()
+    output.seek(0)
+    return output
+
+
 CONTACT_DATA_DICT = {
     # fmt: off
     "first_name": {
@@ -122,6 +148,21 @@ def test_create_dummy_patient_case_data():
     assert set(expectations.values()) == set(actual.values())
 
 
+def test_load_data_dict_normalizes_required():
+    "Show that `load_data_dict` turns the `required` column into booleans"
+    data_dict = contact_data_dict_to_list_of_dicts()
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dict_path = PurePath(data_dir).joinpath("data_dict.csv")
+        with open(data_dict_path, "w") as data_dict_fl:
+            writer = csv.DictWriter(data_dict_fl, fieldnames=[k for k in data_dict[0]])
+            writer.writeheader()
+            for item in data_dict:
+                writer.writerow(item)
+        loaded = load_data_dict(data_dict_path.as_posix())
+    for field, value in CONTACT_DATA_DICT.items():
+        assert loaded[field]["required"] is value["required"]
+
+
 def test_generate_commcare_contact_data():
     """Show that `generate_commcare_contact_data` returns expected schema.
 
@@ -142,6 +183,17 @@ def test_generate_commcare_contact_data():
     assert all([actual[k] == expectation[k] for k in expectation])
 
 
+def test_normalize_legacy_case_data_multi_select():
+    "Show that multi-select values are normalized item by item, as space-separated"
+    values = ["fever, chills", " fever ,chills ", "fever, chills,", ",fever", " "]
+    df = pd.DataFrame({"symptoms_selected": values})
+    normalized = normalize_legacy_case_data(df, CONTACT_DATA_DICT)
+    assert normalized["symptoms_selected"].tolist() == [
+        " ".join(item.strip() for item in value.split(",")) for value in values
+    ]
+    assert normalized["symptoms_selected"].tolist()[2] == "fever chills "
+
+
 class TestCaseDataValidationLogic:
     """Test logic around validating user-supplied case data"""
 
@@ -495,3 +547,69 @@ def test_command_line_script_happy_path(
         assert set(("contact_creation_success", "commcare_contact_case_url")).issubset(
             set(final_report_df.columns)
         )
+
+
+@pytest.mark.parametrize(
+    "sheet_rows",
+    [
+        # clean header, with numbers and blanks in the data
+        [
+            ["first_name", "days_symptoms_lasted", "dob"],
+            ["Ann", 3, "2020-01-01"],
+            [None, None, None],
+            ["Cy", 10.5, None],
+        ],
+        # duplicate header names, including one that collides with a suffix
+        [
+            ["name", "name", "name.1", "name"],
+            ["a", "b", "c", "d"],
+        ],
+        # blank header cells
+        [
+            ["first_name", None, "dob"],
+            ["Ann", "x", "2020-01-01"],
+        ],
+        # ragged rows: data wider than the header, and a short data row
+        [
+            ["first_name", "last_name", "dob"],
+            ["Ann", "Smith", "2020-01-01", "extra"],
+            ["Cy"],
+        ],
+    ],
+)
+def test_load_xl_wb_sheet_as_df_matches_csv_conversion(sheet_rows):
+    """Show that loading a wb sheet directly matches reading it via CSV conversion,
+    including the column names `pd.read_csv` gives blank and duplicate headers"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = WB_CONTACT_SHEET_NAME
+    for row in sheet_rows:
+        ws.append(row)
+    with tempfile.TemporaryDirectory() as data_dir:
+        wb_path = PurePath(data_dir).joinpath("contacts.xlsx")
+        wb.save(wb_path)
+        expected = pd.read_csv(
+            convert_xl_wb_to_csv_string_io(wb_path), keep_default_na=False, dtype=str
+        )
+        result = load_xl_wb_sheet_as_df(wb_path)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_write_df_to_xl_wb_matches_to_excel():
+    "Show that streaming a report to a wb gives the same cells as `df.to_excel`"
+    df = pd.DataFrame(
+        {
+            "first_name": ["Ann", "Bob", "Cy"],
+            "contact_creation_success": [True, False, float("nan")],
+            "commcare_contact_case_url": ["https://example.com/a", "", float("nan")],
+            "days_symptoms_lasted": [3, 10, 2],
+        }
+    )
+    with tempfile.TemporaryDirectory() as data_dir:
+        expected_path = PurePath(data_dir).joinpath("expected.xlsx")
+        result_path = PurePath(data_dir).joinpath("result.xlsx")
+        df.to_excel(expected_path, index=False, sheet_name=WB_CONTACT_SHEET_NAME)
+        write_df_to_xl_wb(df, result_path)
+        expected = convert_xl_wb_to_csv_string_io(expected_path).getvalue()
+        result = convert_xl_wb_to_csv_string_io(result_path).getvalue()
+    assert result == expected
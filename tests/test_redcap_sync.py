@@ -1,10 +1,16 @@
 import datetime
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import numpy as np
 import pandas as pd
 import pytest
+from sqlalchemy import create_engine
 
+from cc_utilities.command_line.sync_redcap_to_commcare import (
+    main_with_args,
+    redcap_sync_lock,
+    save_redcap_state,
+)
 from cc_utilities.constants import (
     ACCEPTED_INTERVIEW_DISPOSITION_VALUES,
     REDCAP_INTEGRATION_STATUS,
@@ -19,6 +25,7 @@ from cc_utilities.redcap_sync import (
     collapse_checkbox_columns,
     collapse_housing_fields,
     drop_external_ids_not_in_cdms,
+    export_records_chunked,
     get_commcare_cases_with_acceptable_interview_dispositions,
     get_records_matching_dob,
     handle_cdms_matching,
@@ -26,6 +33,7 @@ from cc_utilities.redcap_sync import (
     normalize_phone_cols,
     normalize_temperature_cols,
     populate_symptom_columns,
+    query_sql_mirror_by_external_ids_for_col,
     reject_records_already_filled_out_by_case_investigator,
     rename_fields,
     set_external_id_column,
@@ -283,12 +291,33 @@ def test_upload_incomplete_records(mock_upload_to_commcare):
     ]
     upload_incomplete_records(input_df, "api-key", "project-name", "username")
     assert mock_upload_to_commcare.call_count == 2
-    pd.testing.assert_frame_equal(
-        mock_upload_to_commcare.call_args_list[0][0][0], expected_incomplete_records[0]
+    # records with different external IDs are uploaded concurrently, so in any order
+    uploaded_records = sorted(
+        (call[0][0] for call in mock_upload_to_commcare.call_args_list),
+        key=lambda df: df["record_id"].iloc[0],
     )
-    pd.testing.assert_frame_equal(
-        mock_upload_to_commcare.call_args_list[1][0][0], expected_incomplete_records[1]
+    pd.testing.assert_frame_equal(uploaded_records[0], expected_incomplete_records[0])
+    pd.testing.assert_frame_equal(uploaded_records[1], expected_incomplete_records[1])
+
+
+@patch("cc_utilities.redcap_sync.upload_data_to_commcare")
+def test_upload_incomplete_records_same_external_id_in_order(mock_upload_to_commcare):
+    input_df = pd.DataFrame(
+        {
+            "record_id": ["1", "2", "3"],
+            "stuff": ["first", None, "last"],
+            "external_id": ["1111", "2222", "1111"],
+        },
+        index=[1, 2, 3],
     )
+    upload_incomplete_records(input_df, "api-key", "project-name", "username")
+    assert mock_upload_to_commcare.call_count == 3
+    uploaded_record_ids = [
+        call[0][0]["record_id"].iloc[0]
+        for call in mock_upload_to_commcare.call_args_list
+        if call[0][0]["external_id"].iloc[0] == "1111"
+    ]
+    assert uploaded_record_ids == ["1", "3"]
 
 
 def test_set_external_id_column():
@@ -628,3 +657,83 @@ def test_reject_records_already_filled_out_by_case_investigator():
         mock_import_records_to_redcap.call_args[0][0], expected_reject_records
     )
     pd.testing.assert_frame_equal(accepted_records, expected_accepted_records)
+
+
+def test_export_records_chunked():
+    """Records are exported a chunk of record IDs at a time and concatenated"""
+    all_records = pd.DataFrame(
+        {
+            "record_id": ["1", "1", "2", "3"],
+            "redcap_repeat_instance": ["", "1", "", ""],
+        }
+    )
+
+    def mock_export_records(records=None, fields=None, **kwargs):
+        assert kwargs["filter_logic"] == "[x] = 1"
+        if fields:
+            return all_records[fields]
+        return all_records[all_records["record_id"].isin(records)]
+
+    projects = []
+
+    def mock_project(*args):
+        project = MagicMock()
+        project.export_records.side_effect = mock_export_records
+        projects.append(project)
+        return project
+
+    with patch("cc_utilities.redcap_sync.redcap.Project", side_effect=mock_project):
+        records = export_records_chunked(
+            "chunked_url", "key", chunk_size=2, max_workers=2, filter_logic="[x] = 1"
+        )
+    pd.testing.assert_frame_equal(records, all_records)
+    # one call for the IDs, then one per chunk of 2 unique IDs
+    assert sum(project.export_records.call_count for project in projects) == 3
+    # the chunks are exported by the worker threads' own projects
+    assert projects[0].export_records.call_count == 1
+
+
+def test_redcap_sync_lock(tmp_path):
+    """A second sync can't take the lock while the first holds it"""
+    state_file = str(tmp_path / "state.yaml")
+    with redcap_sync_lock(state_file) as locked:
+        if not locked:
+            pytest.skip("File locks are not supported on this platform")
+        with pytest.raises(ValueError):
+            with redcap_sync_lock(state_file):
+                pass
+    # and it's released afterwards
+    with redcap_sync_lock(state_file):
+        pass
+
+
+@patch("cc_utilities.command_line.sync_redcap_to_commcare.export_records_chunked")
+def test_min_sync_interval_skips_recent_sync(mock_export_records_chunked, tmp_path):
+    """REDCap isn't contacted if the last sync started within min_sync_interval"""
+    state_file = str(tmp_path / "state.yaml")
+    state = {"date_begin": datetime.datetime.now(), "in_progress": False}
+    save_redcap_state(state, state_file)
+    args = ["user", "key", "project", "url", "redcap_key", "cdms_id"]
+    main_with_args(*args, [], [], [], state_file, "db_url", False, min_sync_interval=5)
+    mock_export_records_chunked.assert_not_called()
+
+
+def test_query_sql_mirror_by_external_ids_for_col(tmp_path):
+    """Only rows with a matching external ID and a DOB are returned"""
+    db_url = f"sqlite:///{tmp_path / 'mirror.db'}"
+    pd.DataFrame(
+        {
+            "external_id": ["1", "2", "3", "4"],
+            "dob": ["2000-01-01", "2000-01-02", None, "2000-01-04"],
+            "interview_disposition": ["a", "b", "c", "d"],
+            "unrelated": ["w", "x", "y", "z"],
+        }
+    ).to_sql("patient", create_engine(db_url), index=False)
+    df = pd.DataFrame({"external_id": ["1", "1", "2", "3"]})
+    rows = query_sql_mirror_by_external_ids_for_col(
+        df, db_url, "external_id", "patient", "interview_disposition"
+    )
+    assert sorted(rows, key=lambda row: row["external_id"]) == [
+        {"external_id": "1", "interview_disposition": "a"},
+        {"external_id": "2", "interview_disposition": "b"},
+    ]
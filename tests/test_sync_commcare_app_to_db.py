@@ -0,0 +1,43 @@
+from cc_utilities.command_line import sync_commcare_app_to_db
+from cc_utilities.command_line.sync_commcare_app_to_db import (
+    get_app_case_types_with_properties_from_api,
+)
+
+
+def test_app_structure_cache_ttl(monkeypatch, tmp_path):
+    """A fresh cached structure is reused, unless it lacks a requested case type"""
+    calls = []
+
+    def mock_get_application_structure_if_modified(*args, **kwargs):
+        calls.append(kwargs)
+        structure = {
+            "modules": [
+                {"case_type": "contact", "case_properties": ["name", "parent/name"]}
+            ]
+        }
+        return structure, {"etag": None, "last_modified": None}
+
+    monkeypatch.setattr(
+        sync_commcare_app_to_db,
+        "get_application_structure_if_modified",
+        mock_get_application_structure_if_modified,
+    )
+
+    def get_structure(case_types):
+        return get_app_case_types_with_properties_from_api(
+            "project",
+            "user",
+            "key",
+            "app-id",
+            None,
+            app_structure_cache_dir=tmp_path,
+            app_structure_cache_ttl=60,
+            case_types=case_types,
+        )
+
+    assert get_structure(["contact"]) == {"contact": ["name"]}
+    assert len(calls) == 1
+    assert get_structure(["contact"]) == {"contact": ["name"]}
+    assert len(calls) == 1
+    get_structure(["patient"])
+    assert len(calls) == 2
@@ -1,5 +1,12 @@
+import sqlite3
+import tempfile
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePath
 
+import pytest
+import requests
 from faker import Faker
 
 from cc_utilities import twilio_lookup
@@ -14,12 +21,28 @@ from cc_utilities.constants import (
 from cc_utilities.twilio_lookup import (
     COMMCARE_CAN_RECEIVE_SMS_FIELD_NAME,
     TWILIO_MOBILE_CODE,
+    RateLimiter,
+    TwilioLookUpError,
     add_bad_ids,
+    check_twilio_credentials,
+    close_twilio_sessions,
+    count_unprocessed_phone_numbers,
     get_bad_ids,
+    iter_unprocessed_phone_numbers,
     process_records,
 )
 
 
+@pytest.fixture(autouse=True)
+def twilio_lookup_state_db(monkeypatch, tmp_path):
+    """Keep the bad IDs state DB out of the working directory"""
+    monkeypatch.setattr(
+        twilio_lookup,
+        "TWILIO_LOOKUP_STATE_DB_FILE",
+        str(tmp_path / "twilio_lookup_state.db"),
+    )
+
+
 class MockTwilioPhoneTypeMobileResponse:
     "Used to mock expected requests.response from Twilio when valid US mobile number"
 
@@ -190,3 +213,70 @@ class TestBulkProcessNumbersCanReceiveSms:
         assert set(get_bad_ids("contact")) == set(bad_ids)
         # IDs are specific to case_type
         assert get_bad_ids("other") == []
+
+
+def test_iter_unprocessed_phone_numbers():
+    "Show that unprocessed numbers are streamed in full and match the count"
+    with tempfile.TemporaryDirectory() as data_dir:
+        db_path = PurePath(data_dir).joinpath("contacts.db")
+        conn = sqlite3.connect(db_path)
+        conn.execute(
+            f"CREATE TABLE contact (id text, {COMMCARE_PHONE_FIELD} text, "
+            f"{COMMCARE_CAN_RECEIVE_SMS_FIELD_NAME} text)"
+        )
+        rows = [(str(i), "" if i % 3 == 0 else "9195551234", None) for i in range(25)]
+        conn.executemany("INSERT INTO contact VALUES (?, ?, ?)", rows)
+        conn.commit()
+        conn.close()
+        db_url = f"sqlite:///{db_path}"
+        expected_ids = {id_ for id_, phone, _ in rows if phone}
+        unprocessed = list(iter_unprocessed_phone_numbers(db_url, fetch_size=4))
+        assert count_unprocessed_phone_numbers(db_url) == len(expected_ids)
+        assert {row["id"] for row in unprocessed} == expected_ids
+
+
+def test_rate_limiter_spaces_out_calls_across_threads():
+    "Show that `RateLimiter` lets through at most `per_second` calls a second"
+    rate_limiter = RateLimiter(50)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda _: rate_limiter.wait(), range(11)))
+    # the first call goes straight through, the other ten are 1/50 s apart
+    assert time.monotonic() - start >= 10 / 50
+
+
+def test_check_twilio_credentials(monkeypatch):
+    """Bad Twilio credentials raise a `TwilioLookUpError`"""
+
+    class MockSession:
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+        def get(self, url, auth=None):
+            response = requests.models.Response()
+            response.status_code = self.status_code
+            return response
+
+    monkeypatch.setattr(twilio_lookup, "get_twilio_session", lambda: MockSession(200))
+    check_twilio_credentials("sid", "token")
+    monkeypatch.setattr(twilio_lookup, "get_twilio_session", lambda: MockSession(401))
+    with pytest.raises(TwilioLookUpError):
+        check_twilio_credentials("sid", "token")
+
+
+def test_process_records_reuses_sessions_across_batches(monkeypatch):
+    """Lookups on a shared executor keep using the same per-thread sessions"""
+    sessions = set()
+
+    def mock_request(*args, **kwargs):
+        sessions.add(twilio_lookup.get_twilio_session())
+        return MockTwilioPhoneTypeMobileResponse()
+
+    monkeypatch.setattr(twilio_lookup, "twilio_http_request", mock_request)
+    data = [{"id": i, COMMCARE_PHONE_FIELD: "9195551234"} for i in range(10)]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for _ in range(3):
+            process_records(data, "id", "sid", "token", executor=executor)
+    assert 1 <= len(sessions) <= 2
+    close_twilio_sessions()
+    assert twilio_lookup._all_twilio_sessions == []